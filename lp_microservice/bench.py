@@ -0,0 +1,126 @@
+import argparse
+import json
+import statistics
+import sys
+import time
+from urllib.parse import parse_qs
+
+import requests
+
+from lp_microservice.cache_admin import DEFAULT_SERVICE_URL
+from lp_microservice.cassette import read_cassette
+
+
+def _percentile(values: list[float], percentile: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * percentile), len(ordered) - 1)]
+
+
+def _mp_urls_in(session: list[dict]) -> set[str]:
+    mp_urls = set()
+    for request in session:
+        mp_urls.update(parse_qs(request["query"]).get("mp_url", []))
+        if request["body"]:
+            try:
+                body = json.loads(request["body"])
+            except ValueError:
+                continue
+            if isinstance(body, dict) and isinstance(body.get("mp_url"), str):
+                mp_urls.add(body["mp_url"])
+    return mp_urls
+
+
+def replay_session(base_url: str, session: list[dict]) -> list[dict]:
+    """
+    Send the recorded client requests to a running service one after another, measuring each one.
+    """
+    results = []
+    for request in session:
+        url = f"{base_url}{request['path']}" + (f"?{request['query']}" if request["query"] else "")
+        start = time.perf_counter()
+        r = requests.request(
+            request["method"],
+            url,
+            data=request["body"].encode("utf-8") or None,
+            headers={"Content-Type": "application/json"} if request["body"] else {},
+        )
+        results.append(
+            {
+                "method": request["method"],
+                "path": request["path"],
+                "status": r.status_code,
+                "latency_ms": round((time.perf_counter() - start) * 1000, 2),
+                "upstream_calls": int(r.headers.get("X-LP-Upstream-Calls", 0)),
+            }
+        )
+    return results
+
+
+def summarize(runs: list[list[dict]]) -> dict:
+    latencies = [result["latency_ms"] for run in runs for result in run]
+    return {
+        "runs": len(runs),
+        "requests": len(latencies),
+        "total_latency_ms": round(sum(latencies) / len(runs), 2),
+        "p50_latency_ms": round(statistics.median(latencies), 2),
+        "p95_latency_ms": round(_percentile(latencies, 0.95), 2),
+        "upstream_calls": sum(result["upstream_calls"] for run in runs for result in run) / len(runs),
+        "errors": sum(result["status"] >= 400 for run in runs for result in run),
+    }
+
+
+def _parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="lp_microservice_bench",
+        description=(
+            "Replay the reviewer session recorded in a cassette against a running lp-microservice and report "
+            "end-to-end latency and upstream call counts. Start the service with "
+            "LP_MICROSERVICE_REPLAY=<cassette> to serve Launchpad responses from the same cassette."
+        ),
+    )
+    parser.add_argument("cassette", help="Cassette recorded with LP_MICROSERVICE_RECORD=<cassette>.")
+    parser.add_argument(
+        "--url", default=DEFAULT_SERVICE_URL, help="URL of the service under test (default: %(default)s)."
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="Number of times to replay the session.")
+    parser.add_argument(
+        "--cold", action="store_true", help="Invalidate the cache of every MP in the session before each run."
+    )
+    parser.add_argument("--output", help="Write the summary and per-request results to this JSON file.")
+    parser.add_argument("--baseline", help="A previous --output file to compare against.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    base_url = args.url.rstrip("/")
+    session = [entry for entry in read_cassette(args.cassette) if entry["type"] == "client"]
+    if not session:
+        print(f"No client requests recorded in {args.cassette}")
+        sys.exit(1)
+
+    runs = []
+    for run in range(1, args.repeat + 1):
+        if args.cold:
+            for mp_url in _mp_urls_in(session):
+                requests.post(f"{base_url}/admin/cache/invalidate", json={"mp_url": mp_url})
+        runs.append(replay_session(base_url, session))
+        print(f"Run {run}/{args.repeat}:")
+        for result in runs[-1]:
+            print(
+                f"  {result['method']:5} {result['path']:40} ({result['status']}) {result['latency_ms']:9.2f}ms "
+                f"{result['upstream_calls']:3} upstream calls"
+            )
+
+    summary = summarize(runs)
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "runs": runs}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["summary"]
+        print("Compared to baseline:")
+        for metric in ("total_latency_ms", "p50_latency_ms", "p95_latency_ms", "upstream_calls", "errors"):
+            delta = summary[metric] - baseline[metric]
+            print(f"  {metric:18} {baseline[metric]:>10} -> {summary[metric]:>10} ({delta:+.2f})")
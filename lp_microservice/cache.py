@@ -0,0 +1,309 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Callable, Optional, Union
+
+from diskcache import Cache, Disk
+from diskcache.core import UNKNOWN
+
+from lp_microservice.lp_service import canonical_mp_url
+from lp_microservice.profiling import record_cache_operation
+
+# Setup disk caching
+CACHE_DIRECTORY = "/var/cache/lp-microservice"
+# Size bound of the in-process memory tier in front of the disk cache
+MEMORY_TIER_MAX_BYTES = 64 * 1024 * 1024
+# Entries bigger than this are only kept on disk so a single huge diff can't flush the whole memory tier
+MEMORY_TIER_MAX_ENTRY_BYTES = 8 * 1024 * 1024
+
+# Separates the resource type, canonical MP URL and extra parts of a cache key
+KEY_SEPARATOR = "|"
+# Entries written before cache keys were canonical have no resource type
+LEGACY_RESOURCE_TYPE = "legacy"
+
+# Per-key write generations are forgotten past this many keys, cancelling the promotions in flight at that moment
+MEMORY_TIER_MAX_TRACKED_WRITES = 100_000
+
+_MISSING = object()
+
+
+def cache_key(resource_type: str, mp_url: str, *parts: Union[str, int]) -> str:
+    """
+    Build the cache key of a resource belonging to an MP, e.g. `diff_text|https://api.launchpad.net/devel/...|42`.
+
+    The MP URL is canonicalized and the parts are stringified, so the different links to the same MP and int vs str
+    ids all map to a single entry.
+    """
+    return KEY_SEPARATOR.join([resource_type, canonical_mp_url(mp_url), *(str(part).strip() for part in parts)])
+
+
+def resource_type_of(key: str) -> str:
+    return key.split(KEY_SEPARATOR, 1)[0] if KEY_SEPARATOR in key else LEGACY_RESOURCE_TYPE
+
+
+def _mp_url_of(key: str) -> Optional[str]:
+    key_parts = key.split(KEY_SEPARATOR)
+    return key_parts[1] if len(key_parts) > 1 else None
+
+
+def _stored_size(size: int, db_value: Any) -> int:
+    # diskcache reports a size only for values kept in files, inline ones are the database value itself
+    if size:
+        return size
+    if isinstance(db_value, (bytes, bytearray, memoryview)):
+        return len(db_value)
+    return sys.getsizeof(db_value)
+
+
+class SizeRecordingDisk(Disk):
+    """
+    A diskcache `Disk` remembering, per thread, the serialized size of the last value it stored or fetched, so the
+    memory tier can account for a value without serializing it a second time.
+    """
+
+    def __init__(self, directory: str, **kwargs: Any):
+        super().__init__(directory, **kwargs)
+        self._last_size = threading.local()
+
+    @property
+    def last_size(self) -> int:
+        return int(self._last_size.value)
+
+    def store(self, value: Any, read: bool, key: Any = UNKNOWN) -> tuple:
+        size, mode, filename, db_value = super().store(value, read, key=key)
+        self._last_size.value = _stored_size(size, db_value)
+        return size, mode, filename, db_value
+
+    def fetch(self, mode: int, filename: Optional[str], value: Any, read: bool) -> Any:
+        result = super().fetch(mode, filename, value, read)
+        if filename is not None:
+            self._last_size.value = os.path.getsize(os.path.join(self._directory, filename))
+        else:
+            self._last_size.value = _stored_size(0, value)
+        return result
+
+
+class MemoryTier:
+    """
+    A thread-safe, byte-size-bounded LRU map of cache entries.
+    """
+
+    def __init__(self, max_bytes: int = MEMORY_TIER_MAX_BYTES, max_entry_bytes: int = MEMORY_TIER_MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # bumped by every write, a disk read racing with a write to the same key never promotes a stale value
+        self.generation = 0
+        # generation of the last write of each key, and of the last write that may have touched any key
+        self._key_generations: dict[str, int] = {}
+        self._bulk_generation = 0
+        self._entries: OrderedDict[str, tuple[Any, int, Optional[float]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default: Any = _MISSING) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] <= time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key: str, value: Any, size: int, expire_time: Optional[float] = None) -> None:
+        with self._lock:
+            self._record_write(key)
+            self._insert(key, value, size, expire_time)
+
+    def promote(self, key: str, value: Any, size: int, expire_time: Optional[float], generation: int) -> None:
+        """
+        Insert a value that was just read from disk, unless the key was written since `generation` was read.
+        """
+        with self._lock:
+            last_write = max(self._key_generations.get(key, 0), self._bulk_generation)
+            if last_write > generation or key in self._entries:
+                return
+            self._insert(key, value, size, expire_time)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._record_write(key)
+            self._remove(key)
+
+    def delete_where(self, predicate: Callable[[str], bool]) -> int:
+        with self._lock:
+            # the predicate may match keys that are only on disk, so no promotion in flight can be trusted
+            self._record_write(None)
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._record_write(None)
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _record_write(self, key: Optional[str]) -> None:
+        self.generation += 1
+        if key is None or len(self._key_generations) >= MEMORY_TIER_MAX_TRACKED_WRITES:
+            self._key_generations.clear()
+            self._bulk_generation = self.generation
+        if key is not None:
+            self._key_generations[key] = self.generation
+
+    def _insert(self, key: str, value: Any, size: int, expire_time: Optional[float]) -> None:
+        self._remove(key)
+        if size > self.max_entry_bytes:
+            return
+        self._entries[key] = (value, size, expire_time)
+        self.current_bytes += size
+        # evict least recently used entries until we are back under the size bound
+        while self.current_bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry[1]
+
+
+class TieredCache:
+    """
+    An in-process memory tier in front of a diskcache `Cache`.
+
+    Writes go through to disk first and then to memory, reads are served from memory when possible and otherwise
+    from disk, promoting the entry into memory. Other processes writing to the same cache directory (e.g. the cache
+    warmer) are only seen for keys that are not already in this process' memory tier.
+
+    Entries belonging to an MP are tagged with its canonical URL so everything cached for one MP can be invalidated
+    at once, and reads are counted per resource type for the admin stats.
+    """
+
+    def __init__(self, disk: Cache, max_memory_bytes: int = MEMORY_TIER_MAX_BYTES):
+        self.disk = disk
+        self.memory = MemoryTier(max_bytes=max_memory_bytes)
+        self._counters: defaultdict[str, dict[str, int]] = defaultdict(
+            lambda: {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        )
+        self._counters_lock = threading.Lock()
+
+    def _count(self, key: str, outcome: str) -> None:
+        with self._counters_lock:
+            self._counters[resource_type_of(key)][outcome] += 1
+
+    def get(self, key: str, default: Any = None) -> Any:
+        start = time.perf_counter()
+        value = self.memory.get(key)
+        if value is not _MISSING:
+            self._count(key, "memory_hits")
+            record_cache_operation("get:memory", key, True, (time.perf_counter() - start) * 1000)
+            return value
+        generation = self.memory.generation
+        value, expire_time = self.disk.get(key, default=_MISSING, expire_time=True)
+        if value is _MISSING:
+            self._count(key, "misses")
+            record_cache_operation("get:disk", key, False, (time.perf_counter() - start) * 1000)
+            return default
+        self.memory.promote(key, value, self.disk.disk.last_size, expire_time, generation)
+        self._count(key, "disk_hits")
+        record_cache_operation("get:disk", key, True, (time.perf_counter() - start) * 1000)
+        return value
+
+    def set(self, key: str, value: Any, expire: Optional[float] = None) -> None:
+        start = time.perf_counter()
+        self.disk.set(key=key, value=value, expire=expire, tag=_mp_url_of(key))
+        self.memory.set(key, value, self.disk.disk.last_size, None if expire is None else time.time() + expire)
+        record_cache_operation("set", key, None, (time.perf_counter() - start) * 1000)
+
+    def delete(self, key: str) -> None:
+        self.disk.delete(key)
+        self.memory.delete(key)
+
+    def clear(self) -> None:
+        self.disk.clear()
+        self.memory.clear()
+
+    def invalidate_mp(self, mp_url: str) -> int:
+        """
+        Drop every cached resource of an MP from both tiers.
+
+        Returns:
+            int: The number of entries removed from disk.
+        """
+        canonical_url = canonical_mp_url(mp_url)
+        self.memory.delete_where(lambda key: _mp_url_of(key) == canonical_url)
+        return int(self.disk.evict(canonical_url))
+
+    def stats(self) -> dict:
+        """
+        Report entry counts, bytes, age and hit ratio per resource type. Hit counts are since the daemon started.
+        """
+        now = time.time()
+        by_type: defaultdict[str, dict[str, Any]] = defaultdict(
+            lambda: {"entries": 0, "bytes": 0, "oldest_age_s": None, "newest_age_s": None}
+        )
+        # diskcache has no public API for per-entry sizes and store times, so read them from its Cache table.
+        # Small values are stored inline (size 0), bigger ones in files (size is the file size).
+        rows = self.disk._sql("SELECT key, store_time, CASE WHEN size > 0 THEN size ELSE length(value) END FROM Cache")
+        for key, store_time, size in rows:
+            type_stats = by_type[resource_type_of(str(key))]
+            age = round(now - store_time, 1)
+            type_stats["entries"] += 1
+            type_stats["bytes"] += size or 0
+            if type_stats["entries"] == 1:
+                type_stats["oldest_age_s"] = type_stats["newest_age_s"] = age
+            else:
+                type_stats["oldest_age_s"] = max(age, type_stats["oldest_age_s"])
+                type_stats["newest_age_s"] = min(age, type_stats["newest_age_s"])
+        with self._counters_lock:
+            counters = {resource_type: dict(counts) for resource_type, counts in self._counters.items()}
+        for resource_type, counts in counters.items():
+            type_stats = by_type[resource_type]
+            type_stats.update(counts)
+            lookups = counts["memory_hits"] + counts["disk_hits"] + counts["misses"]
+            type_stats["hit_ratio"] = round((counts["memory_hits"] + counts["disk_hits"]) / lookups, 3)
+        return {
+            "disk_bytes": self.disk.volume(),
+            "memory": self.memory.stats(),
+            "resource_types": dict(by_type),
+        }
+
+    def compact(self) -> dict:
+        """
+        Remove expired entries and entries written before cache keys were canonical, then shrink the database file.
+        """
+        expired = self.disk.expire()
+        legacy_keys = [key for key in self.disk.iterkeys() if resource_type_of(str(key)) == LEGACY_RESOURCE_TYPE]
+        for key in legacy_keys:
+            self.delete(key)
+        culled = self.disk.cull()
+        volume_before = self.disk.volume()
+        self.disk._sql("VACUUM")
+        return {
+            "expired": expired,
+            "legacy_removed": len(legacy_keys),
+            "culled": culled,
+            "bytes_reclaimed": max(volume_before - self.disk.volume(), 0),
+        }
+
+
+CACHE = TieredCache(Cache(CACHE_DIRECTORY, tag_index=True, disk=SizeRecordingDisk))
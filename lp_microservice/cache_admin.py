@@ -0,0 +1,43 @@
+import argparse
+import json
+import sys
+
+import requests
+
+# The daemon owns the in-memory cache tier, so the CLI goes through its admin API rather than the cache directory
+DEFAULT_SERVICE_URL = "http://localhost:8698"
+
+
+def _parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="lp_microservice_cache", description="Inspect and manage the lp-microservice cache."
+    )
+    parser.add_argument(
+        "--url", default=DEFAULT_SERVICE_URL, help="URL of the running lp-microservice (default: %(default)s)."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="Show entry counts, bytes, hit ratio and age per resource type.")
+    invalidate_parser = subparsers.add_parser("invalidate", help="Drop everything cached for one MP.")
+    invalidate_parser.add_argument("mp_url", help="Any link to the MP (web or API).")
+    subparsers.add_parser("compact", help="Remove expired and legacy entries and shrink the cache database.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    base_url = args.url.rstrip("/")
+    if args.command == "stats":
+        method, path, body = "GET", "/admin/cache/stats", None
+    elif args.command == "invalidate":
+        method, path, body = "POST", "/admin/cache/invalidate", {"mp_url": args.mp_url}
+    else:
+        method, path, body = "POST", "/admin/cache/compact", None
+    try:
+        r = requests.request(method, f"{base_url}{path}", json=body)
+    except requests.ConnectionError:
+        print(f"Could not reach lp-microservice at {base_url}. Is the daemon running?")
+        sys.exit(1)
+    if r.status_code >= 400:
+        print(f"Request failed ({r.status_code}): {r.text}")
+        sys.exit(1)
+    print(json.dumps(r.json(), indent=2))
@@ -0,0 +1,187 @@
+import base64
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Optional
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from lp_microservice import lp_service
+
+logger = logging.getLogger(__name__)
+
+# Set one of these to a cassette file path to record or replay Launchpad traffic when the daemon starts
+RECORD_ENV_VAR = "LP_MICROSERVICE_RECORD"
+REPLAY_ENV_VAR = "LP_MICROSERVICE_REPLAY"
+# Multiplies the recorded upstream latencies during replay (0 replays as fast as possible)
+REPLAY_LATENCY_SCALE_ENV_VAR = "LP_MICROSERVICE_REPLAY_LATENCY_SCALE"
+
+# Only these response headers are kept in cassettes
+RECORDED_RESPONSE_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+
+
+def _scrub(values: Optional[dict]) -> dict:
+    # credentials only ever travel in the Authorization header, which is never recorded; drop oauth fields regardless
+    return {k: v for k, v in (values or {}).items() if not str(k).startswith("oauth_")}
+
+
+def _match_key(method: str, url: str, params: Optional[dict], data: Optional[dict]) -> str:
+    return json.dumps([method, url, _scrub(params), _scrub(data)], sort_keys=True, default=str)
+
+
+class CassetteRecorder:
+    """
+    Sends Launchpad requests for real and appends every request/response pair (with its duration) to a cassette file,
+    one JSON object per line. Requests the daemon itself receives are appended too, so the reviewer session can be
+    replayed against another build.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._started = time.time()
+
+    def _append(self, entry: dict) -> None:
+        entry["offset_s"] = round(time.time() - self._started, 3)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, default=str) + "\n")
+
+    def __call__(
+        self, method: str, url: str, headers: dict, params: dict, data: Optional[dict] = None
+    ) -> requests.Response:
+        start = time.perf_counter()
+        r = lp_service._send_request(method, url, headers, params, data)
+        duration_ms = (time.perf_counter() - start) * 1000
+        try:
+            body, body_encoding = r.content.decode("utf-8"), "utf-8"
+        except UnicodeDecodeError:
+            body, body_encoding = base64.b64encode(r.content).decode("ascii"), "base64"
+        self._append(
+            {
+                "type": "upstream",
+                "method": method,
+                "url": url,
+                "params": _scrub(params),
+                "data": _scrub(data),
+                "status": r.status_code,
+                "reason": r.reason,
+                "headers": {k: r.headers[k] for k in RECORDED_RESPONSE_HEADERS if k in r.headers},
+                "body": body,
+                "body_encoding": body_encoding,
+                "duration_ms": round(duration_ms, 2),
+            }
+        )
+        return r
+
+    def record_client_request(self, method: str, path: str, query: str, body: str) -> None:
+        self._append({"type": "client", "method": method, "path": path, "query": query, "body": body})
+
+
+class CassettePlayer:
+    """
+    Stands in for Launchpad by answering requests from a recorded cassette, sleeping for the recorded (optionally
+    scaled) duration first.
+
+    Identical requests are answered in the order they were recorded. Once the recorded answers for a request run out,
+    the last one is repeated. Requests that were never recorded get a 404.
+    """
+
+    def __init__(self, path: str, latency_scale: float = 1.0):
+        self.latency_scale = latency_scale
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._interactions: defaultdict[str, deque] = defaultdict(deque)
+        for interaction in read_cassette(path):
+            if interaction["type"] == "upstream":
+                key = _match_key(interaction["method"], interaction["url"], interaction["params"], interaction["data"])
+                self._interactions[key].append(interaction)
+
+    def _next_interaction(self, key: str) -> Optional[dict]:
+        with self._lock:
+            recorded = self._interactions.get(key)
+            if not recorded:
+                self.misses += 1
+                return None
+            interaction: dict = recorded.popleft() if len(recorded) > 1 else recorded[0]
+            return interaction
+
+    def __call__(
+        self, method: str, url: str, headers: dict, params: dict, data: Optional[dict] = None
+    ) -> requests.Response:
+        interaction = self._next_interaction(_match_key(method, url, params, data))
+        r = requests.Response()
+        r.url = url
+        r.encoding = "utf-8"
+        if interaction is None:
+            logger.warning("[REPLAY MISS] %s %s %s %s", method, url, params, data)
+            r.status_code, r.reason, r._content = 404, "Not Recorded", b""
+            return r
+        time.sleep(interaction["duration_ms"] / 1000 * self.latency_scale)
+        r.status_code = interaction["status"]
+        r.reason = interaction["reason"]
+        r.headers = CaseInsensitiveDict(interaction["headers"])
+        if interaction["body_encoding"] == "base64":
+            r._content = base64.b64decode(interaction["body"])
+        else:
+            r._content = interaction["body"].encode("utf-8")
+        return r
+
+
+def read_cassette(path: str) -> list[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class _ActiveCassette:
+    # the recorder of the running daemon, set by `install_from_environment`
+    recorder: Optional[CassetteRecorder] = None
+
+
+_active = _ActiveCassette()
+
+
+def record_client_request(method: str, path: str, query: str, body: str) -> None:
+    """
+    Append a request received by the daemon to the cassette. Does nothing unless recording.
+    """
+    if _active.recorder is not None:
+        _active.recorder.record_client_request(method, path, query, body)
+
+
+def is_recording() -> bool:
+    return _active.recorder is not None
+
+
+def replay_requested() -> bool:
+    """
+    Whether `install_from_environment` is going to replay Launchpad traffic (recording takes precedence).
+    """
+    return bool(os.environ.get(REPLAY_ENV_VAR)) and not os.environ.get(RECORD_ENV_VAR)
+
+
+def install_from_environment() -> Optional[str]:
+    """
+    Start recording or replaying Launchpad traffic if asked to through the environment.
+
+    Returns:
+        Optional[str]: "record", "replay" or None.
+    """
+    record_path = os.environ.get(RECORD_ENV_VAR)
+    replay_path = os.environ.get(REPLAY_ENV_VAR)
+    if record_path:
+        _active.recorder = CassetteRecorder(record_path)
+        lp_service.set_transport(_active.recorder)
+        logger.info("Recording Launchpad traffic to %s", record_path)
+        return "record"
+    if replay_path:
+        latency_scale = float(os.environ.get(REPLAY_LATENCY_SCALE_ENV_VAR, "1.0"))
+        lp_service.set_transport(CassettePlayer(replay_path, latency_scale))
+        # replayed responses need no real credentials, but the auth header is still built for every request
+        lp_service.LP_CREDS = {"access_token": "replay", "access_secret": "replay"}
+        logger.info("Replaying Launchpad traffic from %s with latency scale %s", replay_path, latency_scale)
+        return "replay"
+    return None
@@ -0,0 +1,105 @@
+import dataclasses
+import gzip
+import hashlib
+import json
+from typing import Any, Optional
+
+from fastapi import Request, Response
+
+# Bodies smaller than this are sent as-is, gzip would barely shrink them
+GZIP_MIN_BYTES = 1024
+# Responses built per request favour speed, payloads compressed once (see `encode_payload`) favour size
+GZIP_LEVEL = 6
+PRECOMPRESSED_GZIP_LEVEL = 9
+
+# Immutable resources (e.g. preview diffs) may be kept by the browser without revalidating
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+# Mutable resources are revalidated with If-None-Match on every use
+MUTABLE_CACHE_CONTROL = "private, no-cache"
+
+
+@dataclasses.dataclass
+class EncodedPayload:
+    """
+    A serialized response body with its ETag and, when it was compressed ahead of time, its gzip encoding.
+    """
+
+    body: bytes
+    etag: str
+    gzipped: Optional[bytes] = None
+
+
+def json_bytes(value: Any) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _etag_of(body: bytes) -> str:
+    # weak, because the identity and gzip representations of a body share it
+    return f'W/"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def encode_payload(body: bytes, precompress: bool = False) -> EncodedPayload:
+    """
+    Wrap a serialized body for `encoded_response`.
+
+    Args:
+        body (bytes): The serialized body.
+        precompress (bool): Compress the body now, at a high level, so the payload can be cached and served to any
+            number of clients without compressing it again. Use this for immutable resources.
+
+    Returns:
+        EncodedPayload: The body with its ETag.
+    """
+    gzipped = None
+    if precompress and len(body) >= GZIP_MIN_BYTES:
+        gzipped = gzip.compress(body, compresslevel=PRECOMPRESSED_GZIP_LEVEL, mtime=0)
+    return EncodedPayload(body=body, etag=_etag_of(body), gzipped=gzipped)
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.strip().partition(";")
+        if name.strip().lower() not in ("gzip", "*"):
+            continue
+        quality = params.strip().lower()
+        if quality.startswith("q="):
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison, so W/ prefixes are ignored on both sides
+    opaque_tag = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque_tag for candidate in if_none_match.split(","))
+
+
+def encoded_response(request: Request, payload: EncodedPayload, media_type: str, immutable: bool = False) -> Response:
+    """
+    Answer with a payload in the best encoding the client accepts, or with a bodiless 304 when the client already has
+    it (its If-None-Match matches the payload's ETag).
+
+    Payloads that were not compressed ahead of time are gzipped here when the client accepts it and they are big
+    enough to be worth it.
+    """
+    headers = {
+        "ETag": payload.etag,
+        "Vary": "Accept-Encoding",
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else MUTABLE_CACHE_CONTROL,
+    }
+    if etag_matches(request.headers.get("if-none-match"), payload.etag):
+        return Response(status_code=304, headers=headers)
+    if len(payload.body) >= GZIP_MIN_BYTES and accepts_gzip(request.headers.get("accept-encoding", "")):
+        gzipped = payload.gzipped
+        if gzipped is None:
+            gzipped = gzip.compress(payload.body, compresslevel=GZIP_LEVEL, mtime=0)
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=gzipped, media_type=media_type, headers=headers)
+    return Response(content=payload.body, media_type=media_type, headers=headers)
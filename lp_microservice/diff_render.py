@@ -0,0 +1,171 @@
+import re
+from typing import Optional
+
+from pygments.lexer import Lexer
+from pygments.lexers import get_lexer_for_filename
+from pygments.token import STANDARD_TYPES
+from pygments.util import ClassNotFound
+
+# Bump whenever the rendered structure changes so stale cached renders are not served
+RENDER_FORMAT_VERSION = 1
+# Files with more changed lines than this are sent without highlight tokens
+MAX_HIGHLIGHTED_LINES_PER_FILE = 5000
+
+_HUNK_HEADER_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+_LINE_KINDS = {" ": "context", "-": "del", "+": "add", "\\": "meta"}
+
+
+def _path_from_header(line: str) -> Optional[str]:
+    """
+    Get the file path out of a `--- a/path` or `+++ b/path` line (bzr diffs add a tab and a timestamp).
+    """
+    path = line[4:].split("\t")[0].strip().strip("'")
+    if path == "/dev/null":
+        return None
+    if path.startswith(("a/", "b/")):
+        path = path[2:]
+    return path
+
+
+def _token_class(ttype) -> str:
+    # walk up the token hierarchy until we find a type with a short pygments css class (e.g. "k", "s2", "c1")
+    while ttype not in STANDARD_TYPES:
+        ttype = ttype.parent
+    token_class = STANDARD_TYPES[ttype]
+    # whitespace needs no styling, folding it into plain text lets it merge with its neighbours
+    return "" if token_class == "w" else token_class
+
+
+def _highlight_lines(lexer: Lexer, lines: list[str]) -> Optional[list[list[list[str]]]]:
+    """
+    Highlight a block of source lines in one go (so multi-line strings and comments are recognised) and split the
+    result back into lines of [css_class, text] tokens. Returns None if the lexer output does not line up.
+    """
+    highlighted: list[list[list[str]]] = [[]]
+    for ttype, value in lexer.get_tokens("\n".join(lines)):
+        token_class = _token_class(ttype)
+        for i, part in enumerate(value.split("\n")):
+            if i > 0:
+                highlighted.append([])
+            if not part:
+                continue
+            line_tokens = highlighted[-1]
+            # merge neighbouring tokens of the same class to keep the payload small
+            if line_tokens and line_tokens[-1][0] == token_class:
+                line_tokens[-1][1] += part
+            else:
+                line_tokens.append([token_class, part])
+    if len(highlighted) != len(lines):
+        return None
+    return highlighted
+
+
+def _get_lexer(path: Optional[str]) -> Optional[Lexer]:
+    if not path:
+        return None
+    try:
+        return get_lexer_for_filename(path, stripnl=False, stripall=False, ensurenl=False)
+    except ClassNotFound:
+        return None
+
+
+def _highlight_file(file: dict) -> None:
+    """
+    Fill in the tokens of every hunk line of a file. The old side (context and deleted lines) and the new side
+    (context and added lines) are highlighted separately so each is valid source on its own.
+    """
+    diff_lines = [line for hunk in file["hunks"] for line in hunk["lines"]]
+    lexer = _get_lexer(file["new_path"] or file["old_path"])
+    file["language"] = lexer.name if lexer else None
+    old_side = [line for line in diff_lines if line["kind"] in ("context", "del")]
+    new_side = [line for line in diff_lines if line["kind"] in ("context", "add")]
+    if lexer and len(old_side) + len(new_side) <= MAX_HIGHLIGHTED_LINES_PER_FILE:
+        for side in (old_side, new_side):
+            highlighted = _highlight_lines(lexer, [line["text"] for line in side])
+            if highlighted is None:
+                continue
+            for line, tokens in zip(side, highlighted):
+                line["tokens"] = tokens
+    for line in diff_lines:
+        if "tokens" not in line:
+            line["tokens"] = [["", line["text"]]] if line["text"] else []
+        del line["text"]
+
+
+def render_diff(diff_text: str) -> dict:
+    """
+    Split a preview diff into files, hunks and lines, with syntax highlight tokens for every hunk line.
+
+    Every line carries its `diff_line_no`: its 1-based position in the whole diff text, which is what Launchpad uses
+    as the `line_number` of inline comments. Hunk lines also carry their line numbers in the old and new file.
+
+    Args:
+        diff_text (str): The text of the preview diff.
+
+    Returns:
+        dict: {"version": ..., "preamble": [...], "files": [...]} where each file has `old_path`, `new_path`,
+            `language`, its `header` lines and its `hunks`. Tokens are [css_class, text] pairs using the short
+            pygments css class names (e.g. "k" for keywords), "" for plain text.
+    """
+    preamble: list[dict] = []
+    files: list[dict] = []
+    file: Optional[dict] = None
+    hunk: Optional[dict] = None
+    old_line_no = new_line_no = 0
+    old_remaining = new_remaining = 0
+
+    for diff_line_no, text in enumerate(diff_text.split("\n"), start=1):
+        if hunk is not None and (old_remaining > 0 or new_remaining > 0 or text.startswith("\\")):
+            kind = _LINE_KINDS.get(text[:1], "context")
+            line = {"kind": kind, "diff_line_no": diff_line_no, "old_line_no": None, "new_line_no": None}
+            if kind in ("context", "del"):
+                line["old_line_no"] = old_line_no
+                old_line_no += 1
+                old_remaining -= 1
+            if kind in ("context", "add"):
+                line["new_line_no"] = new_line_no
+                new_line_no += 1
+                new_remaining -= 1
+            line["text"] = text if kind == "meta" else text[1:]
+            hunk["lines"].append(line)
+            continue
+
+        hunk_header = _HUNK_HEADER_RE.match(text)
+        if hunk_header and file is not None:
+            old_start, old_count, new_start, new_count = (
+                int(group) if group is not None else 1 for group in hunk_header.groups()
+            )
+            hunk = {
+                "header": text,
+                "diff_line_no": diff_line_no,
+                "old_start": old_start,
+                "old_count": old_count,
+                "new_start": new_start,
+                "new_count": new_count,
+                "lines": [],
+            }
+            file["hunks"].append(hunk)
+            old_line_no, new_line_no = old_start, new_start
+            old_remaining, new_remaining = old_count, new_count
+            continue
+
+        hunk = None
+        # a new file starts at a git/bzr file header, or at a `---` line once the current file already has hunks
+        starts_file = text.startswith(("diff ", "=== ")) or (
+            text.startswith("--- ") and (file is None or file["hunks"])
+        )
+        if starts_file:
+            file = {"old_path": None, "new_path": None, "language": None, "header": [], "hunks": []}
+            files.append(file)
+        if file is None:
+            preamble.append({"diff_line_no": diff_line_no, "text": text})
+            continue
+        if text.startswith("--- "):
+            file["old_path"] = _path_from_header(text)
+        elif text.startswith("+++ "):
+            file["new_path"] = _path_from_header(text)
+        file["header"].append({"diff_line_no": diff_line_no, "text": text})
+
+    for file in files:
+        _highlight_file(file)
+    return {"version": RENDER_FORMAT_VERSION, "preamble": preamble, "files": files}
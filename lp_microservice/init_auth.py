@@ -1,8 +1,10 @@
 # your_package/init_auth.py
+from lp_microservice.log_pipeline import configure_logging
 from lp_microservice.lp_service import perform_authentication
 
 
 def main():
     # set log level to INFO
+    configure_logging(default_format="text")
     perform_authentication()
     print("Authentication completed.")
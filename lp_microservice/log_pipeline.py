@@ -0,0 +1,198 @@
+import atexit
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+from pprint import pformat
+from typing import Any, Optional
+
+from lp_microservice.profiling import BACKGROUND_THREAD_PREFIX
+
+# Root log level, e.g. DEBUG
+LOG_LEVEL_ENV_VAR = "LP_MICROSERVICE_LOG_LEVEL"
+# "json" (one JSON object per line) or "text"
+LOG_FORMAT_ENV_VAR = "LP_MICROSERVICE_LOG_FORMAT"
+# Fraction of the records of a category that are kept, e.g. "upstream=0.1,uvicorn.access=0"
+LOG_SAMPLING_ENV_VAR = "LP_MICROSERVICE_LOG_SAMPLING"
+
+# Records pass `extra={"category": ...}` to be sampled as a group, records without one are sampled by logger name
+CATEGORY_ATTRIBUTE = "category"
+# Records waiting for the background thread beyond this are dropped instead of blocking the request thread
+LOG_QUEUE_MAX_RECORDS = 10000
+TEXT_FORMAT = "%(levelname)s:%(name)s:%(message)s"
+
+# Attributes every LogRecord has, anything else on a record was passed through `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+
+class LazyPrettyFormat:
+    """
+    Pretty-prints an object only when (and if) the log record carrying it is formatted, which happens on the logging
+    thread. The object must not be changed after it is logged.
+    """
+
+    def __init__(self, obj: Any):
+        self.obj = obj
+
+    def __str__(self) -> str:
+        return pformat(self.obj)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line, with the fields passed through `extra` as top-level keys.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only a fraction of the records of each configured category. Warnings and errors are always kept.
+    """
+
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self.rates.get(getattr(record, CATEGORY_ATTRIBUTE, record.name))
+        return rate is None or random.random() < rate
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    A `QueueHandler` that only merges the message with its args on the thread that logged, while the args are still
+    what was logged. Tracebacks, and the args of records with `LazyPrettyFormat` args, are left for the logging
+    thread to format. Records are dropped when the queue is full.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if isinstance(record.args, tuple) and any(isinstance(arg, LazyPrettyFormat) for arg in record.args):
+            return record
+        # a copy, so other handlers of the record still see its args
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+class _LoggingThread:
+    """
+    Takes records off the queue and hands them to the handler on a background thread, named like the other
+    background threads so the sampling profiler leaves it out.
+    """
+
+    def __init__(self, record_queue: queue.Queue, handler: logging.Handler):
+        self.queue = record_queue
+        self.handler = handler
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name=f"{BACKGROUND_THREAD_PREFIX}logging", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Write out the records already queued, then stop the thread.
+        """
+        if self._thread is None:
+            return
+        self.queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _run(self) -> None:
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.handler.handle(record)
+
+
+class _Pipeline:
+    # the logging thread of the current configuration, see `configure_logging`
+    listener: Optional[_LoggingThread] = None
+
+
+_pipeline = _Pipeline()
+
+
+def parse_sampling_rates(spec: str) -> dict[str, float]:
+    """
+    Parse sampling rates given as "category=rate,...", e.g. "upstream=0.1,uvicorn.access=0".
+    """
+    rates = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        category, _, rate = item.partition("=")
+        rates[category.strip()] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+
+def configure_logging(default_format: str = "json") -> None:
+    """
+    Send all logging through a queue to a background thread that formats and writes the records to stderr, so the
+    threads serving requests only pay for creating the records they actually keep.
+
+    The level, format and per-category sampling rates are read from the environment, see the *_ENV_VAR constants.
+    Calling this again replaces the previous configuration.
+
+    Args:
+        default_format (str): "json" or "text", used unless overridden through the environment.
+    """
+    if _pipeline.listener is not None:
+        _pipeline.listener.stop()
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    if os.environ.get(LOG_FORMAT_ENV_VAR, default_format) == "text":
+        stream_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    else:
+        stream_handler.setFormatter(JsonFormatter())
+
+    record_queue: queue.Queue = queue.Queue(LOG_QUEUE_MAX_RECORDS)
+    queue_handler = DeferredQueueHandler(record_queue)
+    queue_handler.addFilter(SamplingFilter(parse_sampling_rates(os.environ.get(LOG_SAMPLING_ENV_VAR, ""))))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(os.environ.get(LOG_LEVEL_ENV_VAR, "INFO").upper())
+
+    _pipeline.listener = _LoggingThread(record_queue, stream_handler)
+    _pipeline.listener.start()
+
+
+def _flush_on_exit() -> None:
+    if _pipeline.listener is not None:
+        _pipeline.listener.stop()
+
+
+atexit.register(_flush_on_exit)
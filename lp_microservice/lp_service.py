@@ -1,7 +1,10 @@
 import enum
 from itertools import islice
 import random
+import re
+import threading
 import time
+import weakref
 from typing import Literal, Optional, Union
 import concurrent.futures
 import requests
@@ -11,26 +14,16 @@ import webbrowser
 import os
 
 import logging
-from pprint import pformat, pprint
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+from lp_microservice.log_pipeline import LazyPrettyFormat
+from lp_microservice.profiling import record_upstream_call
+
 logger = logging.getLogger(__name__)
 
 
 def log_pprint(obj, level=logging.INFO):
-    if level == logging.DEBUG:
-        logger.debug(pformat(obj))
-    elif level == logging.INFO:
-        logger.info(pformat(obj))
-    elif level == logging.WARNING:
-        logger.warning(pformat(obj))
-    elif level == logging.ERROR:
-        logger.error(pformat(obj))
-    elif level == logging.CRITICAL:
-        logger.critical(pformat(obj))
-    else:
-        logger.log(level, pformat(obj))
+    # only pretty-printed if the record is kept, and then on the logging thread
+    logger.log(level, "%s", LazyPrettyFormat(obj))
 
 
 LP_CREDS = None
@@ -75,19 +68,19 @@ def wait_for_credentials(timeout=300, poll_interval=5):
 def _auth_step_1() -> tuple[str, str]:
     data = {"oauth_consumer_key": "launchpyd", "oauth_signature_method": "PLAINTEXT", "oauth_signature": "&"}
     r = requests.post("https://launchpad.net/+request-token", data=data)
-    logger.debug(f"Auth Step 1 Response Status: {r.status_code}")
-    logger.debug(f"Auth Step 1 Response Text: {r.text}")
+    logger.debug("Auth Step 1 Response Status: %s", r.status_code)
+    logger.debug("Auth Step 1 Response Text: %s", r.text)
     # Get oauth_token and oauth_token_secret from response
     oauth_token = r.text.split("&")[0].split("=")[1]
     oauth_token_secret = r.text.split("&")[1].split("=")[1]
-    logger.debug(f"OAuth Token: {oauth_token}, OAuth Token Secret: {oauth_token_secret}")
+    logger.debug("OAuth Token: %s, OAuth Token Secret: %s", oauth_token, oauth_token_secret)
     return oauth_token, oauth_token_secret
 
 
 def _auth_step_2(oauth_token: str):
     # Redirect user to authorization URL
     auth_url = f"https://launchpad.net/+authorize-token?oauth_token={oauth_token}"
-    logger.debug(f"Redirecting user to: {auth_url}")
+    logger.debug("Redirecting user to: %s", auth_url)
     print("Opening browser for authentication. Please authorize the app.")
     webbrowser.open(auth_url)
     input("Press Enter after you have authorized the app.")
@@ -102,8 +95,8 @@ def _auth_step_3(oauth_token: str, oauth_token_secret: str):
         "oauth_token": oauth_token,
     }
     r = requests.post("https://launchpad.net/+access-token", data=data)
-    logger.debug(f"Auth Step 3 Response Status: {r.status_code}")
-    logger.debug(f"Auth Step 3 Response Text: {r.text}")
+    logger.debug("Auth Step 3 Response Status: %s", r.status_code)
+    logger.debug("Auth Step 3 Response Text: %s", r.text)
     # Get access_token and access_secret from response
     access_token = r.text.split("&")[0].split("=")[1]
     access_secret = r.text.split("&")[1].split("=")[1]
@@ -111,7 +104,7 @@ def _auth_step_3(oauth_token: str, oauth_token_secret: str):
     os.makedirs(os.path.dirname(LP_CREDS_PATH), exist_ok=True)
     with open(LP_CREDS_PATH, "w") as f:
         json.dump({"access_token": access_token, "access_secret": access_secret}, f)
-    logger.debug(f"Access token and secret saved to {LP_CREDS_PATH}")
+    logger.debug("Access token and secret saved to %s", LP_CREDS_PATH)
 
 
 def perform_authentication():
@@ -119,9 +112,9 @@ def perform_authentication():
     try:
         with open(LP_CREDS_PATH, "r") as f:
             LP_CREDS = json.load(f)
-            logger.info(f"Loaded LP credentials from {LP_CREDS_PATH}. No authentication setup needed.")
+            logger.info("Loaded LP credentials from %s. No authentication setup needed.", LP_CREDS_PATH)
     except FileNotFoundError:
-        logger.info(f"{LP_CREDS_PATH} does not exist. Starting authentication process.")
+        logger.info("%s does not exist. Starting authentication process.", LP_CREDS_PATH)
         oauth_token, oauth_token_secret = _auth_step_1()
         _auth_step_2(oauth_token=oauth_token)
         _auth_step_3(oauth_token=oauth_token, oauth_token_secret=oauth_token_secret)
@@ -159,16 +152,82 @@ def _convert_web_link_to_api_link(web_link):
     return web_link.replace("code.launchpad.net", "api.launchpad.net/devel")
 
 
-def _lp_get(url: str, params: dict = {}, verbose: bool = False):
+def canonical_mp_url(mp_url: str) -> str:
+    """
+    Normalize the different ways a merge proposal can be linked to (code.launchpad.net or launchpad.net web links,
+    api.launchpad.net links for any API version, trailing slashes, query strings) to its API URL on devel.
+
+    Args:
+        mp_url (str): Any link to a merge proposal.
+
+    Returns:
+        str: e.g. "https://api.launchpad.net/devel/~owner/project/+git/repo/+merge/123"
+    """
+    url = mp_url.strip().split("#")[0].split("?")[0].rstrip("/")
+    url = re.sub(r"^https?://", "https://", url)
+    url = re.sub(r"^https://(code\.)?launchpad\.net/", "https://api.launchpad.net/devel/", url)
+    return re.sub(r"^https://api\.launchpad\.net/(1\.0|beta|devel)/", "https://api.launchpad.net/devel/", url)
+
+
+def _send_request(
+    method: str, url: str, headers: dict, params: dict, data: Optional[dict] = None
+) -> requests.Response:
+    return requests.request(method, url, headers=headers, params=params, data=data)
+
+
+class _Transport:
+    # Holds the function sending every Launchpad API request. Swapped out by cassette.py to record or replay traffic.
+    def __init__(self, send):
+        self.send = send
+
+
+_transport = _Transport(_send_request)
+
+
+def set_transport(transport) -> None:
+    """
+    Replace the function that sends Launchpad API requests. It is called as
+    `transport(method, url, headers, params, data)` and must return a `requests.Response`.
+    """
+    _transport.send = transport
+
+
+class LaunchpadApiError(Exception):
+    """
+    Raised when Launchpad rejects a request. `status_code` is the HTTP status Launchpad answered with.
+    """
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _upstream_log_fields(method: str, url: str, r: requests.Response, start: float) -> dict:
+    return {
+        "category": "upstream",
+        "method": method,
+        "url": url,
+        "status": r.status_code,
+        "duration_ms": round((time.perf_counter() - start) * 1000, 2),
+    }
+
+
+def _lp_get(url: str, params: dict = {}, verbose: bool = False, raise_errors: bool = False):
     if url:
         url = _convert_web_link_to_api_link(url)
     else:
         raise ValueError("URL cannot be None")
     headers = _make_auth_header()
-    r = requests.get(url, headers=headers, params=params)
-    logger.info(f"[GET] ({r.status_code}) {url} {[f'{k}={v}' for k, v in params.items()]}")
+    start = time.perf_counter()
+    r = _transport.send("GET", url, headers, params)
+    record_upstream_call("GET", url, params, r.status_code, (time.perf_counter() - start) * 1000)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("[GET] (%s) %s %s", r.status_code, url, params, extra=_upstream_log_fields("GET", url, r, start))
     if r.status_code >= 400:
-        logger.error(f"[GET FAILED] {r.status_code} {r.reason} for {r.url} with params {params}")
+        logger.error("[GET FAILED] %s %s for %s with params %s", r.status_code, r.reason, r.url, params)
+        # with raise_errors only a 404 (nothing at the URL) is answered with None, other failures raise
+        if raise_errors and r.status_code != 404:
+            raise LaunchpadApiError(f"Failed to get {url} with params {params}", status_code=r.status_code)
         return None
     try:
         response_json = json.loads(r.text)
@@ -177,20 +236,29 @@ def _lp_get(url: str, params: dict = {}, verbose: bool = False):
         return response_json
     except json.JSONDecodeError:
         if verbose:
-            logger.error(f"Failed to parse JSON response: {r.text}")
+            logger.error("Failed to parse JSON response: %s", r.text)
         return r
 
 
 def _lp_post(url: str, params: dict = {}, data: dict = {}, verbose: bool = False):
     url = _convert_web_link_to_api_link(url)
     headers = _make_auth_header()
-    r = requests.post(url, headers=headers, params=params, data=data)
-    logger.info(f"[POST] ({r.status_code}) {url} {[f'{k}={v}' for k, v in params.items()]}")
+    start = time.perf_counter()
+    r = _transport.send("POST", url, headers, params, data)
+    record_upstream_call("POST", url, {**params, **data}, r.status_code, (time.perf_counter() - start) * 1000)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(
+            "[POST] (%s) %s %s", r.status_code, url, params, extra=_upstream_log_fields("POST", url, r, start)
+        )
     if verbose:
         log_pprint(data, level=logging.INFO)
     if r.status_code >= 400:
-        logger.error(f"[POST FAILED] {r.status_code} {r.reason} for {r.url} with params {params} and data {data}")
-        raise Exception(f"Failed to post data to {url} with params {params} and data {data}")
+        logger.error(
+            "[POST FAILED] %s %s for %s with params %s and data %s", r.status_code, r.reason, r.url, params, data
+        )
+        raise LaunchpadApiError(
+            f"Failed to post data to {url} with params {params} and data {data}", status_code=r.status_code
+        )
     return r
 
 
@@ -250,7 +318,7 @@ def post_review_comment(mp_url, comment: str, review_vote: ReviewVote = ReviewVo
     Returns:
         None
     """
-    logger.info(f"Posting review comment to MP with vote '{review_vote.value}'")
+    logger.info("Posting review comment to MP with vote '%s'", review_vote.value)
     payload = {
         "ws.op": "createComment",
         "content": comment,
@@ -347,8 +415,9 @@ def parse_comment(comment: dict) -> dict:
 def get_comments(mp_url) -> list[dict]:
     # In case the URL ends with a slash, remove it
     url = f"{mp_url.rstrip('/')}/all_comments"
-    r = _lp_get(url)
-    return [parse_comment(comment) for comment in r["entries"]]
+    # long-lived MPs have more comments than fit in one page
+    comments = _paginate_lp_collection(url)
+    return [parse_comment(comment) for comment in comments]
 
 
 ##############################################################################
@@ -356,6 +425,37 @@ def get_comments(mp_url) -> list[dict]:
 ##############################################################################
 
 
+# Serializes the read-modify-write cycles on the drafts of each preview diff, keyed by (canonical MP URL, preview diff
+# id). Launchpad only lets us replace all drafts at once, so concurrent edits would otherwise overwrite each other.
+# Locks are only referenced weakly, an entry goes away once no edit of its preview diff holds or waits for it.
+_draft_locks: "weakref.WeakValueDictionary[tuple[str, str], _DraftLock]" = weakref.WeakValueDictionary()
+_draft_locks_lock = threading.Lock()
+
+
+class _DraftLock:
+    # threading.Lock objects can't be weakly referenced, so wrap one
+    __slots__ = ("_lock", "__weakref__")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "_DraftLock":
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._lock.release()
+
+
+def _draft_lock(mp_url, preview_diff_id) -> _DraftLock:
+    key = (canonical_mp_url(mp_url), str(preview_diff_id))
+    with _draft_locks_lock:
+        lock = _draft_locks.get(key)
+        if lock is None:
+            lock = _draft_locks[key] = _DraftLock()
+        return lock
+
+
 def get_draft_inline_comments(mp_url, preview_diff_id) -> dict[str, str]:
     """
     Fetch draft inline comments for a preview diff.
@@ -369,7 +469,7 @@ def get_draft_inline_comments(mp_url, preview_diff_id) -> dict[str, str]:
     if r is None:
         logger.info("No draft inline comments found")
         return {}
-    logger.info(f"Found {len(r.items())} draft inline comments")
+    logger.info("Found %s draft inline comments", len(r))
     return r
 
 
@@ -400,18 +500,19 @@ def cancel_inline_draft_comment(mp_url, preview_diff_id, line_no):
     Returns:
         None
     """
-    # Fetch existing draft inline comments for the preview diff
-    existing_draft_comments = get_draft_inline_comments(mp_url, preview_diff_id)
-    logger.info(f"Existing draft comments: {existing_draft_comments}")
-    # Check if the draft comment exists for the specified line_no
-    if str(line_no) not in existing_draft_comments:
-        logger.info(f"Comment does not exist at line {line_no}. Doing nothing.")
-        return
-    logger.info(f"Draft inline comment exists at line {line_no}. Removing it.")
-    # Remove the draft comment for the specified line_no
-    del existing_draft_comments[str(line_no)]
-    # Update the server with the new list of draft comments
-    _put_draft_inline_comments(mp_url, preview_diff_id, existing_draft_comments)
+    with _draft_lock(mp_url, preview_diff_id):
+        # Fetch existing draft inline comments for the preview diff
+        existing_draft_comments = get_draft_inline_comments(mp_url, preview_diff_id)
+        logger.debug("Existing draft comments: %s", existing_draft_comments)
+        # Check if the draft comment exists for the specified line_no
+        if str(line_no) not in existing_draft_comments:
+            logger.info("Comment does not exist at line %s. Doing nothing.", line_no)
+            return
+        logger.info("Draft inline comment exists at line %s. Removing it.", line_no)
+        # Remove the draft comment for the specified line_no
+        del existing_draft_comments[str(line_no)]
+        # Update the server with the new list of draft comments
+        _put_draft_inline_comments(mp_url, preview_diff_id, existing_draft_comments)
 
 
 def get_inline_comments(mp_url, preview_diff_id) -> list[dict]:
@@ -420,7 +521,7 @@ def get_inline_comments(mp_url, preview_diff_id) -> list[dict]:
         "previewdiff_id": preview_diff_id,
     }
     r = _lp_get(mp_url, params=get_inline_comments_params)
-    logger.info(f"Found {len(r)} inline comments")
+    logger.info("Found %s inline comments", len(r))
     return _simplify_incline_comments(r)
 
 
@@ -438,38 +539,67 @@ def submit_and_post_inline_comment(mp_url, preview_diff_id, line_no, comment: st
     Returns:
         None
     """
-    # Fetch existing draft comments
-    existing_draft_comments = get_draft_inline_comments(mp_url, preview_diff_id)
-    logger.info(f"Posting inline comment at line {line_no} with message: {comment}")
-    payload = {
-        "ws.op": "createComment",
-        "content": "",
-        "inline_comments": _stringify_dict({str(line_no): comment}),
-        "previewdiff_id": preview_diff_id,
-    }
-    _lp_post(mp_url, data=payload)
-    # Remove the draft comment if it exists for the same line_no
-    if delete_existing_draft and str(line_no) in existing_draft_comments:
-        del existing_draft_comments[str(line_no)]
-    elif str(line_no) in existing_draft_comments:
-        if existing_draft_comments[str(line_no)] == comment:
-            logger.info("Existing draft comment is the same as the new comment. Removing it.")
+    with _draft_lock(mp_url, preview_diff_id):
+        # Fetch existing draft comments
+        existing_draft_comments = get_draft_inline_comments(mp_url, preview_diff_id)
+        logger.info("Posting inline comment at line %s with message: %s", line_no, comment)
+        payload = {
+            "ws.op": "createComment",
+            "content": "",
+            "inline_comments": _stringify_dict({str(line_no): comment}),
+            "previewdiff_id": preview_diff_id,
+        }
+        _lp_post(mp_url, data=payload)
+        # Remove the draft comment if it exists for the same line_no
+        if delete_existing_draft and str(line_no) in existing_draft_comments:
             del existing_draft_comments[str(line_no)]
-    # Restore the draft comments
-    _put_draft_inline_comments(mp_url, preview_diff_id, existing_draft_comments)
+        elif str(line_no) in existing_draft_comments:
+            if existing_draft_comments[str(line_no)] == comment:
+                logger.info("Existing draft comment is the same as the new comment. Removing it.")
+                del existing_draft_comments[str(line_no)]
+        # Restore the draft comments
+        _put_draft_inline_comments(mp_url, preview_diff_id, existing_draft_comments)
 
 
 def save_draft_inline_comment(mp_url, preview_diff_id, line_no, comment: str):
-    # Fetch existing draft inline comments for the preview diff
-    existing_draft_comments = get_draft_inline_comments(mp_url, preview_diff_id)
-    # Add or update the draft comment at the given line_no
-    if str(line_no) not in existing_draft_comments:
-        logger.info(f"Adding new draft comment at line {line_no}")
-        existing_draft_comments[str(line_no)] = comment
-    else:
-        logger.info(f"Updating draft comment at line {line_no}")
-        existing_draft_comments[str(line_no)] = comment
-    _put_draft_inline_comments(mp_url, preview_diff_id, existing_draft_comments)
+    with _draft_lock(mp_url, preview_diff_id):
+        # Fetch existing draft inline comments for the preview diff
+        existing_draft_comments = get_draft_inline_comments(mp_url, preview_diff_id)
+        # Add or update the draft comment at the given line_no
+        if str(line_no) not in existing_draft_comments:
+            logger.info("Adding new draft comment at line %s", line_no)
+            existing_draft_comments[str(line_no)] = comment
+        else:
+            logger.info("Updating draft comment at line %s", line_no)
+            existing_draft_comments[str(line_no)] = comment
+        _put_draft_inline_comments(mp_url, preview_diff_id, existing_draft_comments)
+
+
+def patch_draft_inline_comments(mp_url, preview_diff_id, changes: dict[str, Optional[str]]) -> dict[str, str]:
+    """
+    Apply many draft inline comment edits at once, with a single read and (if anything changed) a single write.
+
+    Args:
+        mp_url (str): The merge proposal URL.
+        preview_diff_id (str or int): The preview diff ID.
+        changes (dict[str, Optional[str]]): The new draft comment by line number, None to delete the draft on that
+            line.
+
+    Returns:
+        dict[str, str]: The draft inline comments after the edits.
+    """
+    with _draft_lock(mp_url, preview_diff_id):
+        existing_draft_comments = get_draft_inline_comments(mp_url, preview_diff_id)
+        draft_comments = dict(existing_draft_comments)
+        for line_no, comment in changes.items():
+            if comment is None:
+                draft_comments.pop(str(line_no), None)
+            else:
+                draft_comments[str(line_no)] = comment
+        if draft_comments != existing_draft_comments:
+            logger.info("Applying %s draft comment change(s)", len(changes))
+            _put_draft_inline_comments(mp_url, preview_diff_id, draft_comments)
+        return draft_comments
 
 
 def _simplify_incline_comments(inline_comments: list[dict]) -> list[dict]:
@@ -503,24 +633,39 @@ from pydantic import BaseModel, Field
 class Person(BaseModel):
     name: str
     display_name: str
-    description: str
+    # Launchpad returns null for these when the person never set them
+    description: Optional[str] = None
     web_link: str
     self_link: str
-    logo_link: str
-    mugshot_link: str
+    logo_link: Optional[str] = None
+    mugshot_link: Optional[str] = None
 
     @classmethod
     def from_dict(cls, person_dict):
         return cls(
             name=person_dict["name"],
             display_name=person_dict["display_name"],
-            description=person_dict["description"],
+            description=person_dict.get("description"),
             web_link=person_dict["web_link"],
             self_link=person_dict["self_link"],
-            logo_link=person_dict["logo_link"],
-            mugshot_link=person_dict["mugshot_link"],
+            logo_link=person_dict.get("logo_link"),
+            mugshot_link=person_dict.get("mugshot_link"),
         )
 
+
+def get_person(person_link: str) -> Optional[Person]:
+    """
+    Fetch a person (or team) by their API link, e.g. "https://api.launchpad.net/devel/~bob".
+
+    Returns:
+        Optional[Person]: None if Launchpad has no such person.
+
+    Raises:
+        LaunchpadApiError: If Launchpad fails to answer.
+    """
+    r = _lp_get(person_link, raise_errors=True)
+    return Person.from_dict(r) if r else None
+
 ##############################################################################
 
 
@@ -533,7 +678,25 @@ def get_preview_diff_text(
     return r.content.decode("utf-8")
 
 
-# def get_review_votes
+def parse_vote(vote: dict) -> dict:
+    return {
+        "reviewer_name": vote["reviewer_link"].split("/~")[-1],
+        "reviewer_link": vote["reviewer_link"],
+        "review_type": vote["review_type"],
+        "is_pending": vote["is_pending"],
+        "comment_link": vote["comment_link"],
+        "date_created": vote["date_created"],
+    }
+
+
+def get_review_votes(mp_url: str) -> list[dict]:
+    """
+    Fetch the review requests and reviews of an MP. The vote itself (Approve, Needs Fixing, ...) is not part of the
+    vote reference, it lives on the comment at `comment_link`.
+    """
+    # In case the URL ends with a slash, remove it
+    votes = _paginate_lp_collection(f"{mp_url.rstrip('/')}/votes")
+    return [parse_vote(vote) for vote in votes]
 
 
 class MergeProposalApiObject(BaseModel):
@@ -556,15 +719,15 @@ class MergeProposalApiObject(BaseModel):
 
     @property
     def all_comments_collection_link(self):
-        return f"https://api.launchpad.net/devel/{self.self_link}/all_comments"
+        return f"{self.self_link}/all_comments"
     
     @property
     def preview_diffs_collection_link(self):
-        return f"https://api.launchpad.net/devel/{self.self_link}/preview_diffs"
+        return f"{self.self_link}/preview_diffs"
     
     @property
     def votes_collection_link(self):
-        return f"https://api.launchpad.net/devel/{self.self_link}/votes"
+        return f"{self.self_link}/votes"
 
     @classmethod
     def from_api_response(cls, mp: dict):
@@ -588,9 +751,10 @@ class MergeProposalApiObject(BaseModel):
             # print(f"Error parsing MP object: {e} for mp with url {mp['web_link']}")
             return None
         
-def get_merge_proposal(mp_url: str) -> MergeProposalApiObject:
-    r = _lp_get(mp_url)
-    return MergeProposalApiObject(**r)
+def get_merge_proposal(mp_url: str) -> Optional[MergeProposalApiObject]:
+    # None only when there is no such MP, any other failure raises so it is not mistaken for (and cached as) one
+    r = _lp_get(mp_url, raise_errors=True)
+    return MergeProposalApiObject.from_api_response(r) if r else None
 
 
 # get currently authenticated user
@@ -619,7 +783,8 @@ def fetch_all_mps_in_batches(mp_urls, batch_size=5, num_diffs=1) -> list[MergePr
             for future in concurrent.futures.as_completed(futures):
                 try:
                     mp_result = future.result()
-                    all_mps.append(mp_result)
+                    if mp_result is not None:
+                        all_mps.append(mp_result)
                 except Exception as exc:
                     print(f"Fetching MP generated an exception: {exc}")
     return all_mps
@@ -1,41 +1,157 @@
+import concurrent.futures
+import datetime
+import inspect
+import json
 import os
 import sys
-from diskcache import Cache
-from fastapi import Body, FastAPI, HTTPException
-from typing import Union
+import tempfile
+from fastapi import Body, FastAPI, HTTPException, Query, Request
+from typing import Any, AsyncIterator, Callable, Literal, Optional, Union
 import logging
 import uvicorn
-
-from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.routing import APIRoute
+from lp_microservice.cache import CACHE
+from lp_microservice.compression import encode_payload, encoded_response, json_bytes
+from lp_microservice.cassette import install_from_environment, is_recording, record_client_request, replay_requested
+from lp_microservice.log_pipeline import configure_logging
+from lp_microservice.mp_index import get_project_index
+from lp_microservice.outbox import OUTBOX_DIRECTORY, Outbox, OutboxOperation
+from lp_microservice.profiling import (
+    RequestTrace,
+    SamplingProfiler,
+    age_header,
+    arm_profiling,
+    in_current_trace,
+    list_profiles,
+    log_if_slow,
+    measure_cpu_time,
+    read_profile,
+    save_profile,
+    server_timing_header,
+    should_profile,
+    trace_request,
+)
+from lp_microservice.resources import (
+    InvalidSince,
+    get_comments_cached,
+    get_comments_since,
+    get_inline_comments_cached,
+    get_inline_comments_since,
+    get_merge_proposal_cached,
+    get_preview_diff_text_cached,
+    get_preview_diff_text_encoded,
+    get_rendered_diff_cached,
+    get_rendered_diff_encoded,
+    get_vote_summary,
+    invalidate_comments,
+    with_authors,
+)
 from lp_microservice.lp_service import (
     get_draft_inline_comments,
     cancel_inline_draft_comment,
-    get_inline_comments,
     submit_and_post_inline_comment,
     save_draft_inline_comment,
-    get_comments,
+    patch_draft_inline_comments,
     post_review_comment,
     post_comment,
     ReviewVote,
+    get_basic_mps_info_for_project,
     wait_for_credentials,
+    LaunchpadApiError,
     LP_CREDS_PATH,
-    get_preview_diff_text,
 )
 
-# Setup disk caching
-CACHE_DIRECTORY = "/var/cache/lp-microservice"
-CACHE = Cache(CACHE_DIRECTORY)
+# Durable queue for comments and reviews posted with `deferred=True`. A replay gets a throwaway one: its writes are
+# delivered to the cassette, and must never be left in the real outbox for the next normal start to post.
+OUTBOX = Outbox(
+    tempfile.mkdtemp(prefix="lp-microservice-replay-outbox-") if replay_requested() else OUTBOX_DIRECTORY
+)
+
+class TracedRoute(APIRoute):
+    """
+    Adds the CPU time spent in each (sync) endpoint to the request trace.
+    """
+
+    def __init__(self, path: str, endpoint: Any, **kwargs: Any):
+        # async endpoints run on the event loop thread, where other requests' work would be counted too
+        if not inspect.iscoroutinefunction(endpoint):
+            endpoint = measure_cpu_time(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
 
 # Initialize the FastAPI app
 app = FastAPI()
+app.router.route_class = TracedRoute
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 logger.info("Hello from main.py")
 
 
+def _is_streamed(response) -> bool:
+    # bodyless responses (304, 204) have no Content-Length either, but nothing left to produce
+    return "content-length" not in response.headers and response.status_code not in (204, 304)
+
+
+async def _close_trace_after_stream(
+    body_iterator: AsyncIterator[Any], trace: RequestTrace, profiler: Optional[SamplingProfiler], name: str
+) -> AsyncIterator[Any]:
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        if profiler:
+            profiler.stop()
+            save_profile(profiler, name)
+        log_if_slow(trace)
+
+
+@app.middleware("http")
+async def trace_and_profile_requests(request: Request, call_next):
+    """
+    Trace every request (upstream calls, cache operations, local time), log the slow ones, and capture a sampling
+    profile when asked to via the profile header or an armed admin profile.
+
+    Streamed responses (no Content-Length, e.g. /votes/summary) send their headers before the body is produced, so
+    they get no Server-Timing, X-LP-Upstream-Calls or X-LP-Profile-Id headers. Their trace is closed once the stream
+    ends instead: they are still logged when slow and their profile is saved for the admin profile listing.
+    """
+    name = f"{request.method} {request.url.path}"
+    if is_recording():
+        record_client_request(
+            request.method, request.url.path, request.url.query, (await request.body()).decode("utf-8", "replace")
+        )
+    profiler = SamplingProfiler() if should_profile(request.url.path, request.headers) else None
+    with trace_request(name) as trace:
+        if profiler:
+            profiler.start()
+        try:
+            response = await call_next(request)
+        except BaseException:
+            if profiler:
+                profiler.stop()
+            raise
+    if _is_streamed(response):
+        response.body_iterator = _close_trace_after_stream(response.body_iterator, trace, profiler, name)
+        return response
+    if profiler:
+        profiler.stop()
+    response.headers["Server-Timing"] = server_timing_header(trace)
+    response.headers["X-LP-Upstream-Calls"] = str(len(trace.upstream_calls))
+    age = age_header(trace)
+    if age is not None:
+        response.headers["Age"] = age
+    if profiler:
+        response.headers["X-LP-Profile-Id"] = save_profile(profiler, name)
+    log_if_slow(trace)
+    return response
+
+
 @app.get("/get_draft_inline_comments")
 def api_get_draft_inline_comments(mp_url: str, preview_diff_id: Union[str, int]):
     try:
@@ -49,7 +165,7 @@ def api_get_draft_inline_comments(mp_url: str, preview_diff_id: Union[str, int])
 def api_cancel_inline_draft_comment(
     mp_url: str = Body(...), preview_diff_id: Union[str, int] = Body(...), line_no: Union[str, int] = Body(...)
 ):
-    logger.debug("[/cancel_inline_draft_comment] received:", mp_url, preview_diff_id, line_no)
+    logger.debug("[/cancel_inline_draft_comment] received: %s %s %s", mp_url, preview_diff_id, line_no)
     try:
         cancel_inline_draft_comment(mp_url, str(preview_diff_id), str(line_no))
         return {"status": "Draft comment canceled successfully"}
@@ -58,15 +174,37 @@ def api_cancel_inline_draft_comment(
         raise HTTPException(status_code=500, detail=str(e)) from e
 
 
-@app.get("/get_inline_comments")
-def api_get_inline_comments(mp_url: str, preview_diff_id: Union[str, int]):
+def _get_inline_comments(
+    mp_url: str, preview_diff_id: Union[str, int], since: Optional[str] = None, refresh: bool = False
+) -> list[dict]:
     try:
-        return get_inline_comments(mp_url, str(preview_diff_id))
+        if since:
+            return get_inline_comments_since(mp_url, preview_diff_id, since, refresh)
+        return get_inline_comments_cached(mp_url, preview_diff_id, refresh)
+    except InvalidSince as e:
+        raise HTTPException(status_code=400, detail=f"Invalid since, expected an ISO 8601 timestamp: {since}") from e
     except Exception as e:
         logger.exception("Error in get_inline_comments")
         raise HTTPException(status_code=500, detail=str(e)) from e
 
 
+@app.get("/get_inline_comments")
+def api_get_inline_comments(
+    request: Request,
+    mp_url: str,
+    preview_diff_id: Union[str, int],
+    since: Optional[str] = None,
+    refresh: bool = False,
+):
+    """
+    Get the inline comments of a preview diff, or with `since` (an ISO 8601 timestamp) only those made after it.
+    They may come from a copy cached a few minutes ago, its age in seconds is in the `Age` header. Pass `refresh` to
+    get them from Launchpad.
+    """
+    payload = encode_payload(json_bytes(_get_inline_comments(mp_url, preview_diff_id, since, refresh)))
+    return encoded_response(request, payload, "application/json")
+
+
 @app.post("/submit_and_post_inline_comment")
 def api_submit_and_post_inline_comment(
     mp_url: str = Body(...),
@@ -74,12 +212,33 @@ def api_submit_and_post_inline_comment(
     line_no: Union[str, int] = Body(...),
     comment: str = Body(...),
     delete_existing_draft: bool = Body(default=True),
+    deferred: bool = Body(default=False),
+    idempotency_key: Optional[str] = Body(default=None),
 ):
     logger.debug(
-        "[/submit_and_post_inline_comment] received:", mp_url, preview_diff_id, line_no, comment, delete_existing_draft
+        "[/submit_and_post_inline_comment] received: %s %s %s %r %s",
+        mp_url,
+        preview_diff_id,
+        line_no,
+        comment,
+        delete_existing_draft,
     )
+    if deferred:
+        operation = OUTBOX.enqueue(
+            "submit_and_post_inline_comment",
+            {
+                "mp_url": mp_url,
+                "preview_diff_id": str(preview_diff_id),
+                "line_no": str(line_no),
+                "comment": comment,
+                "delete_existing_draft": delete_existing_draft,
+            },
+            idempotency_key,
+        )
+        return _queued_response(operation)
     try:
         submit_and_post_inline_comment(mp_url, str(preview_diff_id), str(line_no), comment, delete_existing_draft)
+        invalidate_comments(mp_url, preview_diff_id)
         return {"status": "Inline comment submitted and posted successfully"}
     except Exception as e:
         logger.exception("Error in submit_and_post_inline_comment")
@@ -93,7 +252,7 @@ def api_save_draft_inline_comment(
     line_no: Union[str, int] = Body(...),
     comment: str = Body(...),
 ):
-    logger.debug("[/save_draft_inline_comment] received:", mp_url, preview_diff_id, line_no, comment)
+    logger.debug("[/save_draft_inline_comment] received: %s %s %s %r", mp_url, preview_diff_id, line_no, comment)
     try:
         save_draft_inline_comment(mp_url, str(preview_diff_id), str(line_no), comment)
         return {"status": "Draft inline comment saved successfully"}
@@ -102,25 +261,119 @@ def api_save_draft_inline_comment(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+class DraftInlineCommentOperation(BaseModel):
+    op: Literal["set", "delete"]
+    line_no: Union[str, int]
+    comment: Optional[str] = None
+
+
+@app.patch("/draft_inline_comments")
+def api_patch_draft_inline_comments(
+    mp_url: str = Body(...),
+    preview_diff_id: Union[str, int] = Body(...),
+    operations: list[DraftInlineCommentOperation] = Body(...),
+):
+    """
+    Set and delete many draft inline comments of a preview diff in one go, with a single write to Launchpad.
+
+    Args:
+        mp_url (str): The MP URL.
+        preview_diff_id (Union[str, int]): The preview diff ID.
+        operations (list[DraftInlineCommentOperation]): Applied in order. "set" saves `comment` as the draft on
+            `line_no`, "delete" removes the draft on `line_no` if there is one.
+
+    Returns:
+        dict: {"status", "drafts"}, the drafts being every draft inline comment of the preview diff after the edits.
+    """
+    changes: dict[str, Optional[str]] = {}
+    for operation in operations:
+        if operation.op == "set" and operation.comment is None:
+            raise HTTPException(status_code=400, detail=f"Missing comment to set on line {operation.line_no}")
+        changes[str(operation.line_no)] = operation.comment if operation.op == "set" else None
+    try:
+        drafts = patch_draft_inline_comments(mp_url, str(preview_diff_id), changes)
+        return {"status": "Draft inline comments updated successfully", "drafts": drafts}
+    except Exception as e:
+        logger.exception("Error in patch_draft_inline_comments")
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+
 # New endpoints
 
 
-@app.get("/mp/comments")
-def api_get_comments(mp_url: str):
+@app.get("/mp")
+def api_get_merge_proposal(mp_url: str, refresh: bool = False):
+    """
+    Get an MP. It may come from a copy cached a few minutes ago, its age in seconds is in the `Age` header. Pass
+    `refresh` to get it from Launchpad.
+    """
+    try:
+        mp = get_merge_proposal_cached(mp_url, refresh)
+    except LaunchpadApiError as e:
+        logger.exception("Launchpad failed in get_merge_proposal")
+        raise HTTPException(status_code=502, detail=str(e)) from e
+    except Exception as e:
+        logger.exception("Error in get_merge_proposal")
+        raise HTTPException(status_code=500, detail=str(e)) from e
+    if mp is None:
+        raise HTTPException(status_code=404, detail=f"No merge proposal found at {mp_url}")
+    return mp
+
+
+def _get_comments(mp_url: str, since: Optional[str] = None, refresh: bool = False) -> list[dict]:
     try:
-        return get_comments(mp_url)
+        comments = get_comments_since(mp_url, since, refresh) if since else get_comments_cached(mp_url, refresh)
+        return with_authors(comments)
+    except InvalidSince as e:
+        raise HTTPException(
+            status_code=400, detail=f"Invalid since, expected a comment id or an ISO 8601 timestamp: {since}"
+        ) from e
     except Exception as e:
         logger.exception("Error in get_comments")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/mp/comments")
+def api_get_comments(request: Request, mp_url: str, since: Optional[str] = None, refresh: bool = False):
+    """
+    Get the comments of an MP, each with its full `author` (display name, mugshot, ...) resolved from the people
+    cache. The response is gzipped when the client accepts it and carries an ETag, so a client sending it back in
+    If-None-Match gets a bodiless 304 while the comments are unchanged.
+
+    Args:
+        mp_url (str): The MP URL.
+        since (Optional[str]): Only return what a client that already has the comments up to this point is missing:
+            the comments after this comment id, or the comments posted or edited after this ISO 8601 timestamp.
+        refresh (bool): Get the comments from Launchpad rather than from a copy cached a few minutes ago.
+
+    Returns:
+        Response: The comments as JSON, oldest first. The `Age` header is the age in seconds of the comments.
+    """
+    payload = encode_payload(json_bytes(_get_comments(mp_url, since, refresh)))
+    return encoded_response(request, payload, "application/json")
+
+
 @app.post("/post_review_comment")
-def api_post_review_comment(mp_url: str = Body(...), comment: str = Body(...), review_vote: str = Body(default="")):
-    logger.debug("[/post_review_comment] received:", mp_url, comment, review_vote)
+def api_post_review_comment(
+    mp_url: str = Body(...),
+    comment: str = Body(...),
+    review_vote: str = Body(default=""),
+    deferred: bool = Body(default=False),
+    idempotency_key: Optional[str] = Body(default=None),
+):
+    logger.debug("[/post_review_comment] received: %s %r %s", mp_url, comment, review_vote)
     try:
         # Cast review_vote to ReviewVote enum, defaulting to NONE if empty
         review_vote_enum = ReviewVote(review_vote) if review_vote else ReviewVote.NONE
+        if deferred:
+            operation = OUTBOX.enqueue(
+                "post_review_comment",
+                {"mp_url": mp_url, "comment": comment, "review_vote": review_vote_enum.value},
+                idempotency_key,
+            )
+            return _queued_response(operation)
         post_review_comment(mp_url, comment, review_vote_enum)
+        invalidate_comments(mp_url)
         return {"status": "Review comment posted successfully"}
     except ValueError as e:
         logger.exception("Invalid review_vote value")
@@ -131,54 +384,378 @@ def api_post_review_comment(mp_url: str = Body(...), comment: str = Body(...), r
 
 
 @app.post("/post_comment")
-def api_post_comment(mp_url: str = Body(...), comment: str = Body(...)):
-    logger.debug("[/post_comment] received:", mp_url, comment)
+def api_post_comment(
+    mp_url: str = Body(...),
+    comment: str = Body(...),
+    deferred: bool = Body(default=False),
+    idempotency_key: Optional[str] = Body(default=None),
+):
+    logger.debug("[/post_comment] received: %s %r", mp_url, comment)
+    if deferred:
+        operation = OUTBOX.enqueue("post_comment", {"mp_url": mp_url, "comment": comment}, idempotency_key)
+        return _queued_response(operation)
     try:
         post_comment(mp_url, comment)
+        invalidate_comments(mp_url)
         return {"status": "Comment posted successfully"}
     except Exception as e:
         logger.exception("Error in post_comment")
         raise HTTPException(status_code=500, detail=str(e)) from e
 
 
+# Review votes
+
+# Maximum number of MPs whose votes are fetched at the same time
+VOTES_MAX_WORKERS = 16
+
+
+def _stream_vote_summaries(mp_urls: list[str]):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=VOTES_MAX_WORKERS) as executor:
+        futures = {
+            executor.submit(in_current_trace(get_vote_summary), mp_url): mp_url for mp_url in mp_urls
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                summary = future.result()
+            except Exception as e:
+                logger.exception("Error in get_vote_summary")
+                summary = {"mp_url": futures[future], "error": str(e)}
+            yield json.dumps(summary) + "\n"
+
+
+@app.get("/votes/summary")
+def api_get_vote_summaries(
+    mp_url: list[str] = Query(default=[]),
+    project: Optional[str] = None,
+    status: str = "Needs review",
+):
+    """
+    Get the review votes of many MPs at once, e.g. for a "who approved what" board.
+
+    The votes of all MPs are fetched concurrently and each MP's summary is streamed as soon as it is ready, as one
+    JSON object per line (NDJSON). Summaries can arrive in any order.
+
+    Args:
+        mp_url (list[str]): MP URLs to summarize, the parameter can be repeated.
+        project (Optional[str]): Also summarize every MP of this project with the given status.
+        status (str): The status of the project MPs to include. Defaults to "Needs review".
+
+    Returns:
+        StreamingResponse: Lines of {"mp_url", "tally", "reviewers"} or {"mp_url", "error"}.
+    """
+    mp_urls = list(mp_url)
+    if project:
+        try:
+            mp_urls.extend(mp.web_link for mp in get_basic_mps_info_for_project(project, status=status))
+        except Exception as e:
+            logger.exception("Error in get_basic_mps_info_for_project")
+            raise HTTPException(status_code=500, detail=str(e)) from e
+    if not mp_urls:
+        raise HTTPException(status_code=400, detail="Provide at least one mp_url or a project")
+    # the same MP can be both listed explicitly and part of the project
+    mp_urls = list(dict.fromkeys(mp_urls))
+    return StreamingResponse(_stream_vote_summaries(mp_urls), media_type="application/x-ndjson")
+
+
+# Project MP listings
+
+# Maximum number of MPs returned per page of a project listing
+PROJECT_MPS_MAX_LIMIT = 500
+
+
+@app.get("/project/mps")
+def api_query_project_mps(
+    request: Request,
+    project: str,
+    status: list[str] = Query(default=[]),
+    author: Optional[str] = None,
+    source_repository: Optional[str] = None,
+    target_repository: Optional[str] = None,
+    created_after: Optional[datetime.datetime] = None,
+    created_before: Optional[datetime.datetime] = None,
+    review_requested_after: Optional[datetime.datetime] = None,
+    review_requested_before: Optional[datetime.datetime] = None,
+    merged_after: Optional[datetime.datetime] = None,
+    merged_before: Optional[datetime.datetime] = None,
+    sort: Literal["date_created", "date_review_requested", "date_merged"] = "date_created",
+    order: Literal["asc", "desc"] = "desc",
+    offset: int = Query(default=0, ge=0),
+    limit: int = Query(default=50, ge=1, le=PROJECT_MPS_MAX_LIMIT),
+    refresh: bool = False,
+):
+    """
+    Filter, sort and page the MPs of a project, served from an in-memory index of all its MPs that is refreshed in
+    the background, see `mp_index.get_project_index`.
+
+    Args:
+        project (str): The project name.
+        status (list[str]): Only MPs with one of these statuses, the parameter can be repeated. Defaults to all.
+        author (Optional[str]): Only MPs registered by this person (name, ~name or API link).
+        source_repository (Optional[str]): Only MPs from this repository (e.g. "~owner/project/+git/repo").
+        target_repository (Optional[str]): Only MPs into this repository.
+        created_after, created_before, review_requested_after, review_requested_before, merged_after, merged_before
+            (Optional[datetime]): Only MPs with the timestamp in range (inclusive), timestamps without an offset are
+            UTC.
+        sort (str): The timestamp to sort by, MPs without it come last. Defaults to "date_created".
+        order (str): "desc" (newest first, the default) or "asc".
+        offset (int): Number of matching MPs to skip.
+        limit (int): Maximum number of MPs to return.
+        refresh (bool): Refresh the index from Launchpad before answering.
+
+    Returns:
+        Response: {"project", "total", "offset", "limit", "indexed_at", "mps"} as JSON.
+    """
+    try:
+        index = get_project_index(project, refresh=refresh)
+    except Exception as e:
+        logger.exception("Error in get_project_index")
+        raise HTTPException(status_code=500, detail=str(e)) from e
+    date_ranges = {
+        field: (after, before)
+        for field, after, before in (
+            ("date_created", created_after, created_before),
+            ("date_review_requested", review_requested_after, review_requested_before),
+            ("date_merged", merged_after, merged_before),
+        )
+        if after is not None or before is not None
+    }
+    try:
+        result = index.query(
+            statuses=status,
+            author=author,
+            source_repository=source_repository,
+            target_repository=target_repository,
+            date_ranges=date_ranges,
+            sort=sort,
+            descending=order == "desc",
+            offset=offset,
+            limit=limit,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    payload = {"project": project, "offset": offset, "limit": limit, "indexed_at": index.fetched_at, **result}
+    return encoded_response(request, encode_payload(json_bytes(payload)), "application/json")
+
+
+# Outbox endpoints
+
+
+def _queued_response(operation: OutboxOperation) -> JSONResponse:
+    """
+    Answer a deferred write right away with the id the client can poll /outbox/{operation_id} with.
+    """
+    return JSONResponse(
+        status_code=202,
+        content={"status": "Queued for delivery", "operation_id": operation.id, "state": operation.state},
+    )
+
+
+@app.get("/outbox")
+def api_list_outbox_operations(state: Optional[str] = None):
+    return {"operations": OUTBOX.list_operations(state)}
+
+
+@app.get("/outbox/{operation_id}")
+def api_get_outbox_operation(operation_id: str):
+    """
+    Get the delivery state of an operation queued by a deferred write: pending, delivering, delivered or failed.
+    """
+    operation = OUTBOX.get(operation_id)
+    if operation is None:
+        raise HTTPException(status_code=404, detail=f"No outbox operation with id {operation_id}")
+    return operation
+
+
+def _get_preview_diff_text(mp_url: str, preview_diff_id: Union[str, int]) -> str:
+    try:
+        return get_preview_diff_text_cached(mp_url, preview_diff_id)
+    except Exception as e:
+        logger.exception("Error in api_preview_diff_text")
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+
 @app.get("/preview_diff/text", response_class=PlainTextResponse)
 def api_preview_diff_text(
+    request: Request,
     mp_url: str,
     preview_diff_id: Union[str, int],
-) -> str:
+):
     """
     Get the text of the preview diff with the given preview_diff_id, caching the result if not previously fetched.
 
+    Preview diffs never change, so the text is gzipped once and the compressed bytes are cached next to it and served
+    as-is to clients accepting gzip. The ETag lets clients revalidate with a bodiless 304.
+
     Args:
         mp_url (str): The Mattermost MP URL.
         preview_diff_id (Union[str, int]): The preview diff ID.
 
     Returns:
-        str: The text of the preview diff (bytestring).
+        Response: The text of the preview diff.
     """
-    # Create a unique cache key based on the query parameters
-    cache_key = f"{mp_url}_{preview_diff_id}"
+    try:
+        payload = get_preview_diff_text_encoded(mp_url, preview_diff_id)
+    except Exception as e:
+        logger.exception("Error in api_preview_diff_text")
+        raise HTTPException(status_code=500, detail=str(e)) from e
+    return encoded_response(request, payload, "text/plain", immutable=True)
 
-    # Check if result is cached
-    cached_result = CACHE.get(cache_key)
-    if cached_result:
-        return cached_result
 
+def _get_rendered_diff(mp_url: str, preview_diff_id: Union[str, int]) -> dict:
     try:
-        logger.debug(f"No cached result found for diff text with key: {cache_key}")
-        # Fetch the data
-        result = get_preview_diff_text(mp_url, str(preview_diff_id))
-        # Cache the result
-        CACHE.set(
-            key=cache_key,
-            value=result,
-            expire=None,  # No expiration since the preview diff text is immutable
-        )
-        return result
+        return get_rendered_diff_cached(mp_url, preview_diff_id)
+    except Exception as e:
+        logger.exception("Error in api_preview_diff_rendered")
+        raise HTTPException(status_code=500, detail=str(e)) from e
 
+
+@app.get("/preview_diff/rendered")
+def api_preview_diff_rendered(
+    request: Request,
+    mp_url: str,
+    preview_diff_id: Union[str, int],
+):
+    """
+    Get the preview diff split into files, hunks and lines with syntax highlight tokens, so the extension only has to
+    build the DOM. Preview diffs never change, so each one is rendered, serialized and gzipped once and the result is
+    cached forever, see `api_preview_diff_text`.
+
+    Args:
+        mp_url (str): The MP URL.
+        preview_diff_id (Union[str, int]): The preview diff ID.
+
+    Returns:
+        Response: The rendered diff as JSON, see `diff_render.render_diff`.
+    """
+    try:
+        payload = get_rendered_diff_encoded(mp_url, preview_diff_id)
     except Exception as e:
-        logger.exception("Error in api_preview_diff_text")
+        logger.exception("Error in api_preview_diff_rendered")
         raise HTTPException(status_code=500, detail=str(e)) from e
+    return encoded_response(request, payload, "application/json", immutable=True)
+
+
+# Batch endpoint
+
+# Maximum number of batched operations that are run at the same time
+BATCH_MAX_WORKERS = 8
+
+
+class BatchOperation(BaseModel):
+    id: Optional[str] = None
+    op: str
+    params: dict[str, Any] = {}
+
+
+# Read-only endpoints that can be combined into a single /batch request, keyed by their path. Endpoints that build
+# their own encoded response are represented by the function producing their data.
+BATCH_OPERATIONS: dict[str, Callable[..., Any]] = {
+    "/mp": api_get_merge_proposal,
+    "/mp/comments": _get_comments,
+    "/get_inline_comments": _get_inline_comments,
+    "/get_draft_inline_comments": api_get_draft_inline_comments,
+    "/preview_diff/text": _get_preview_diff_text,
+    "/preview_diff/rendered": _get_rendered_diff,
+}
+
+
+def _run_batch_operation(operation: BatchOperation) -> dict:
+    result = {"id": operation.id, "op": operation.op, "status": 200, "result": None, "error": None}
+    if operation.op not in BATCH_OPERATIONS:
+        result.update(status=400, error=f"Unsupported batch operation: {operation.op}")
+        return result
+    function = BATCH_OPERATIONS[operation.op]
+    try:
+        # only a mismatch with the signature is the client's fault, a TypeError raised inside the operation is a 500
+        inspect.signature(function).bind(**operation.params)
+    except TypeError as e:
+        result.update(status=400, error=f"Invalid params for {operation.op}: {e}")
+        return result
+    try:
+        result["result"] = function(**operation.params)
+    except HTTPException as e:
+        result.update(status=e.status_code, error=e.detail)
+    except Exception as e:
+        logger.exception("Error in batch operation %s", operation.op)
+        result.update(status=500, error=str(e))
+    return result
+
+
+@app.post("/batch")
+def api_batch(operations: list[BatchOperation] = Body(..., embed=True)):
+    """
+    Run several read operations in one request. The operations are independent of each other, so they are run
+    concurrently and their upstream fetches overlap.
+
+    Args:
+        operations (list[BatchOperation]): The operations to run. `op` is the path of the endpoint to call (e.g.
+            "/mp/comments"), `params` are its query parameters and the optional `id` is echoed back in the result.
+
+    Returns:
+        dict: {"results": [...]}, one result per operation in the order they were given. Each result carries its own
+            HTTP-like `status` and either a `result` or an `error`.
+    """
+    if not operations:
+        return {"results": []}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(operations), BATCH_MAX_WORKERS)) as executor:
+        # each operation gets its own copy of the context so it is recorded on the trace of this request
+        futures = [executor.submit(in_current_trace(_run_batch_operation), operation) for operation in operations]
+        return {"results": [future.result() for future in futures]}
+
+
+# Cache administration endpoints
+
+
+@app.get("/admin/cache/stats")
+def api_cache_stats():
+    """
+    Get entry counts, bytes, age and hit ratio of the cache per resource type, plus the memory tier's usage.
+    """
+    return CACHE.stats()
+
+
+@app.post("/admin/cache/invalidate")
+def api_cache_invalidate(mp_url: str = Body(..., embed=True)):
+    """
+    Drop everything cached for one MP, whichever link to it is given.
+    """
+    return {"status": "Cache invalidated", "entries_removed": CACHE.invalidate_mp(mp_url)}
+
+
+@app.post("/admin/cache/compact")
+def api_cache_compact():
+    """
+    Remove expired and pre-canonical-key entries from the cache and shrink its database file.
+    """
+    return CACHE.compact()
+
+
+# Profiling endpoints
+
+
+@app.get("/admin/profiles")
+def api_list_profiles():
+    return {"profiles": list_profiles()}
+
+
+@app.get("/admin/profiles/{profile_id}", response_class=PlainTextResponse)
+def api_get_profile(profile_id: str) -> str:
+    """
+    Get a saved profile in collapsed-stack format, ready for flamegraph.pl or speedscope.
+    """
+    profile = read_profile(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"No profile with id {profile_id}")
+    return profile
+
+
+@app.post("/admin/profiles/arm")
+def api_arm_profiling(path_prefix: str = Body(...), count: int = Body(default=1)):
+    """
+    Capture a profile for the next `count` requests whose path starts with `path_prefix`.
+    """
+    arm_profiling(path_prefix, count)
+    return {"status": f"Profiling armed for the next {count} request(s) to {path_prefix}"}
 
 
 # function to get preview diff details info from launchpad
@@ -200,11 +777,15 @@ def prepare_creds_location():
 
 
 def run_server():
-    prepare_creds_location()
-    # Poll for the credentials file, waiting until it exists
-    logger.info("Checking for authentication credentials...")
-    if not wait_for_credentials():
-        logger.info("Authentication not completed. Exiting daemon.")
-        sys.exit(1)
-
-    uvicorn.run(app, host="0.0.0.0", port=8698)  # noqa: S104
+    # replaying recorded Launchpad traffic needs no credentials
+    if install_from_environment() != "replay":
+        prepare_creds_location()
+        # Poll for the credentials file, waiting until it exists
+        logger.info("Checking for authentication credentials...")
+        if not wait_for_credentials():
+            logger.info("Authentication not completed. Exiting daemon.")
+            sys.exit(1)
+    OUTBOX.start()
+
+    # log_config=None leaves uvicorn's loggers (including the per-request uvicorn.access) to our logging pipeline
+    uvicorn.run(app, host="0.0.0.0", port=8698, log_config=None)  # noqa: S104
@@ -0,0 +1,266 @@
+import concurrent.futures
+import datetime
+import logging
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+from lp_microservice.cache import CACHE, KEY_SEPARATOR
+from lp_microservice.lp_service import get_basic_mps_info_for_project, get_merge_proposal
+from lp_microservice.profiling import in_current_trace
+from lp_microservice.resources import refresh_in_background
+
+logger = logging.getLogger(__name__)
+
+# Statuses of the MPs kept in the index, the position of a status is its code in the status column
+INDEXED_STATUSES = ("Work in progress", "Needs review", "Approved", "Merged", "Rejected")
+# MPs with these statuses can still change status, so they are re-fetched by every incremental refresh
+ACTIVE_STATUSES = ("Work in progress", "Needs review", "Approved")
+TIMESTAMP_FIELDS = ("date_created", "date_review_requested", "date_merged")
+
+# How long an index is served before it is refreshed in the background (active MPs only)
+INDEX_FRESH_FOR = 60  # seconds
+# How often the whole index, including merged and rejected MPs, is fetched again
+INDEX_FULL_REFRESH_INTERVAL = 24 * 60 * 60  # seconds
+# Persisted indexes older than this are dropped rather than loaded
+INDEX_MAX_STALE = 7 * 24 * 60 * 60  # seconds
+# Maximum number of upstream fetches run at the same time while refreshing an index
+INDEX_MAX_WORKERS = 8
+
+_indexes: dict[str, "ProjectMpIndex"] = {}
+# one lock per project, so a long first build of one project doesn't hold up queries of the others
+_build_locks: dict[str, threading.Lock] = {}
+_build_locks_lock = threading.Lock()
+
+
+def _epoch(timestamp: Optional[str]) -> float:
+    if not timestamp:
+        return np.nan
+    parsed = datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+
+def person_name(person: str) -> str:
+    # "https://api.launchpad.net/devel/~bob", "~bob" and "bob" all name the same person
+    return person.rstrip("/").split("/")[-1].lstrip("~")
+
+
+def repository_path(repository: str) -> str:
+    # "https://api.launchpad.net/devel/~owner/project/+git/repo" -> "~owner/project/+git/repo"
+    return repository.rstrip("/").split("/devel/")[-1].split("/1.0/")[-1]
+
+
+def _intern(ids: dict[str, int], value: str) -> int:
+    return ids.setdefault(value, len(ids))
+
+
+class ProjectMpIndex:
+    """
+    An immutable snapshot of the MPs of a project, with the fields they are filtered and sorted by held in NumPy
+    columns: status codes, interned author and repository ids, and timestamps (epoch seconds, NaN when unset).
+
+    Refreshing builds a new snapshot and swaps it in, so queries never need a lock.
+    """
+
+    def __init__(self, project: str, mps: list[dict], fetched_at: float, full_fetched_at: float):
+        self.project = project
+        self.mps = mps
+        self.fetched_at = fetched_at
+        self.full_fetched_at = full_fetched_at
+        self.author_ids: dict[str, int] = {}
+        self.repository_ids: dict[str, int] = {}
+        status_codes = {status: code for code, status in enumerate(INDEXED_STATUSES)}
+        self.status = np.array([status_codes[mp["status"]] for mp in mps], dtype=np.uint8)
+        self.author = np.array(
+            [_intern(self.author_ids, person_name(mp["author_link"])) for mp in mps], dtype=np.int32
+        )
+        self.source_repository = np.array(
+            [_intern(self.repository_ids, repository_path(mp["source_git_repository_link"])) for mp in mps],
+            dtype=np.int32,
+        )
+        self.target_repository = np.array(
+            [_intern(self.repository_ids, repository_path(mp["target_git_repository_link"])) for mp in mps],
+            dtype=np.int32,
+        )
+        self.timestamps = {
+            field: np.array([_epoch(mp[field]) for mp in mps], dtype=np.float64) for field in TIMESTAMP_FIELDS
+        }
+
+    def query(
+        self,
+        statuses: Optional[list[str]] = None,
+        author: Optional[str] = None,
+        source_repository: Optional[str] = None,
+        target_repository: Optional[str] = None,
+        date_ranges: Optional[dict[str, tuple[Optional[datetime.datetime], Optional[datetime.datetime]]]] = None,
+        sort: str = "date_created",
+        descending: bool = True,
+        offset: int = 0,
+        limit: int = 50,
+    ) -> dict:
+        """
+        Filter, sort and page the MPs of the project.
+
+        Args:
+            statuses (Optional[list[str]]): Only MPs with one of these statuses.
+            author (Optional[str]): Only MPs registered by this person (name, ~name or API link).
+            source_repository (Optional[str]): Only MPs from this repository (path or API link).
+            target_repository (Optional[str]): Only MPs into this repository (path or API link).
+            date_ranges (Optional[dict]): Only MPs whose timestamp falls in [after, before] for each given
+                timestamp field, either bound can be None. MPs without the timestamp never match.
+            sort (str): The timestamp field to sort by. MPs without it come last.
+            descending (bool): Newest first.
+            offset (int): Number of matching MPs to skip.
+            limit (int): Maximum number of MPs to return.
+
+        Returns:
+            dict: {"total": number of matching MPs, "mps": the requested page of them}.
+
+        Raises:
+            ValueError: If a status or timestamp field is unknown.
+        """
+        mask = np.ones(len(self.mps), dtype=bool)
+        if statuses:
+            unknown = set(statuses) - set(INDEXED_STATUSES)
+            if unknown:
+                raise ValueError(f"Unknown status: {', '.join(sorted(unknown))}")
+            mask &= np.isin(self.status, [INDEXED_STATUSES.index(status) for status in statuses])
+        for column, ids, value in (
+            (self.author, self.author_ids, author and person_name(author)),
+            (self.source_repository, self.repository_ids, source_repository and repository_path(source_repository)),
+            (self.target_repository, self.repository_ids, target_repository and repository_path(target_repository)),
+        ):
+            if value:
+                mask &= column == ids.get(value, -1)
+        for field, (after, before) in (date_ranges or {}).items():
+            if field not in self.timestamps:
+                raise ValueError(f"Unknown timestamp field: {field}")
+            # comparisons with NaN are always false, so MPs without the timestamp are filtered out
+            if after is not None:
+                mask &= self.timestamps[field] >= _epoch(after.isoformat())
+            if before is not None:
+                mask &= self.timestamps[field] <= _epoch(before.isoformat())
+        if sort not in self.timestamps:
+            raise ValueError(f"Unknown sort field: {sort}")
+
+        selected = np.flatnonzero(mask)
+        sort_keys = self.timestamps[sort][selected]
+        # NaN sorts last either way, negating instead of reversing keeps it there when descending
+        order = np.argsort(-sort_keys if descending else sort_keys, kind="stable")
+        page = selected[order[offset : offset + limit]]
+        return {"total": int(selected.size), "mps": [self.mps[i] for i in page]}
+
+
+def _index_key(project: str) -> str:
+    return f"project_mps{KEY_SEPARATOR}{project}"
+
+
+def _fetch_project_mps(project: str, statuses: tuple[str, ...]) -> list[dict]:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(statuses)) as executor:
+        futures = [
+            executor.submit(in_current_trace(get_basic_mps_info_for_project), project, status)
+            for status in statuses
+        ]
+        # an MP changing status between the fetches shows up twice, its later status (in `statuses` order) is kept
+        mps_by_link = {mp.self_link: mp.model_dump() for future in futures for mp in future.result()}
+        return list(mps_by_link.values())
+
+
+def _fetch_merge_proposals(mp_urls: list[str]) -> list[Optional[dict]]:
+    def fetch(mp_url: str) -> Optional[dict]:
+        mp = get_merge_proposal(mp_url)
+        return mp.model_dump() if mp else None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=INDEX_MAX_WORKERS) as executor:
+        futures = [executor.submit(in_current_trace(fetch), mp_url) for mp_url in mp_urls]
+        return [future.result() for future in futures]
+
+
+def _build_index(project: str, previous: Optional[ProjectMpIndex], full: bool) -> ProjectMpIndex:
+    """
+    Fetch the MPs of a project and build a new index of them.
+
+    A full build fetches the MPs of every indexed status. An incremental one only fetches the active MPs and merges
+    them into the previous index. MPs that were active before but are not anymore (merged, rejected, deleted) are
+    fetched one by one to learn their new status.
+    """
+    now = time.time()
+    if full or previous is None:
+        index = ProjectMpIndex(project, _fetch_project_mps(project, INDEXED_STATUSES), now, now)
+    else:
+        active_mps = _fetch_project_mps(project, ACTIVE_STATUSES)
+        active_links = {mp["self_link"] for mp in active_mps}
+        mps_by_link = {mp["self_link"]: mp for mp in previous.mps}
+        left_active = [
+            link
+            for link, mp in mps_by_link.items()
+            if mp["status"] in ACTIVE_STATUSES and link not in active_links
+        ]
+        for link, mp in zip(left_active, _fetch_merge_proposals(left_active)):
+            if mp is None or mp["status"] not in INDEXED_STATUSES:
+                del mps_by_link[link]
+            else:
+                mps_by_link[link] = mp
+        mps_by_link.update((mp["self_link"], mp) for mp in active_mps)
+        index = ProjectMpIndex(project, list(mps_by_link.values()), now, previous.full_fetched_at)
+    _indexes[project] = index
+    CACHE.set(
+        key=_index_key(project),
+        value={"fetched_at": index.fetched_at, "full_fetched_at": index.full_fetched_at, "mps": index.mps},
+        expire=INDEX_MAX_STALE,
+    )
+    logger.info(
+        "Indexed %s MPs of %s (%s)", len(index.mps), project, "full" if full or previous is None else "incremental"
+    )
+    return index
+
+
+def _build_lock(project: str) -> threading.Lock:
+    with _build_locks_lock:
+        return _build_locks.setdefault(project, threading.Lock())
+
+
+def _refresh_in_background(index: ProjectMpIndex) -> None:
+    full = time.time() - index.full_fetched_at > INDEX_FULL_REFRESH_INTERVAL
+
+    def refresh():
+        with _build_lock(index.project):
+            # rebuilt (e.g. with refresh=True) since this snapshot was served, the newer index must not be replaced
+            if _indexes.get(index.project) is not index:
+                return
+            _build_index(index.project, index, full)
+
+    refresh_in_background(_index_key(index.project), refresh)
+
+
+def get_project_index(project: str, refresh: bool = False) -> ProjectMpIndex:
+    """
+    Get the MP index of a project, loading it from the cache or building it on first use. Indexes older than
+    `INDEX_FRESH_FOR` are served while an incremental refresh runs in the background.
+
+    Args:
+        project (str): The project name.
+        refresh (bool): Refresh the index now (incrementally if there is one) instead of serving it as is.
+
+    Returns:
+        ProjectMpIndex: The index.
+    """
+    index = _indexes.get(project)
+    if index is None or refresh:
+        with _build_lock(project):
+            index = _indexes.get(project)
+            if index is None:
+                # persisted by a previous run of the daemon
+                entry = CACHE.get(_index_key(project))
+                if entry is not None:
+                    index = ProjectMpIndex(project, entry["mps"], entry["fetched_at"], entry["full_fetched_at"])
+                    _indexes[project] = index
+            if index is None or refresh:
+                return _build_index(project, index, full=False)
+    if time.time() - index.fetched_at > INDEX_FRESH_FOR:
+        _refresh_in_background(index)
+    return index
@@ -0,0 +1,242 @@
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Literal, Optional
+
+from diskcache import Index
+from pydantic import BaseModel
+
+from lp_microservice.lp_service import (
+    LaunchpadApiError,
+    ReviewVote,
+    get_comments,
+    get_inline_comments,
+    post_comment,
+    post_review_comment,
+    submit_and_post_inline_comment,
+)
+from lp_microservice.profiling import BACKGROUND_THREAD_PREFIX
+from lp_microservice.resources import invalidate_comments
+
+logger = logging.getLogger(__name__)
+
+# Kept next to the credentials rather than in the cache directory: the outbox holds user data that must survive
+OUTBOX_DIRECTORY = "/var/opt/lp-microservice/outbox"
+MAX_DELIVERY_ATTEMPTS = 8
+RETRY_BASE_DELAY = 5  # seconds, doubled after every failed attempt
+RETRY_MAX_DELAY = 600  # seconds
+# Delivered and failed operations are forgotten after this long
+OUTBOX_RETENTION = 7 * 24 * 60 * 60  # seconds
+# Launchpad answers that are worth retrying; any other 4xx is treated as a permanent failure
+RETRYABLE_STATUS_CODES = {408, 429}
+# Allowed difference between our clock and Launchpad's when looking for an earlier delivery of an operation
+CLOCK_SKEW_TOLERANCE = 60  # seconds
+
+OperationKind = Literal["post_comment", "post_review_comment", "submit_and_post_inline_comment"]
+OperationState = Literal["pending", "delivering", "delivered", "failed"]
+
+
+class OutboxOperation(BaseModel):
+    """
+    An outgoing write to Launchpad waiting in (or delivered from) the outbox.
+    """
+
+    id: str
+    kind: OperationKind
+    params: dict[str, Any]
+    idempotency_key: Optional[str] = None
+    state: OperationState = "pending"
+    attempts: int = 0
+    created_at: float
+    updated_at: float
+    next_attempt_at: float
+    last_error: Optional[str] = None
+
+
+def _deliver_post_comment(params: dict) -> None:
+    post_comment(params["mp_url"], params["comment"])
+    invalidate_comments(params["mp_url"])
+
+
+def _deliver_post_review_comment(params: dict) -> None:
+    post_review_comment(params["mp_url"], params["comment"], ReviewVote(params["review_vote"]))
+    invalidate_comments(params["mp_url"])
+
+
+def _deliver_submit_and_post_inline_comment(params: dict) -> None:
+    submit_and_post_inline_comment(
+        params["mp_url"],
+        params["preview_diff_id"],
+        params["line_no"],
+        params["comment"],
+        params["delete_existing_draft"],
+    )
+    invalidate_comments(params["mp_url"], params["preview_diff_id"])
+
+
+_DELIVERERS = {
+    "post_comment": _deliver_post_comment,
+    "post_review_comment": _deliver_post_review_comment,
+    "submit_and_post_inline_comment": _deliver_submit_and_post_inline_comment,
+}
+
+
+def _timestamp(date_str: str) -> float:
+    return datetime.fromisoformat(date_str.replace("Z", "+00:00")).timestamp()
+
+
+def _already_delivered(operation: OutboxOperation) -> bool:
+    """
+    Check whether an earlier attempt of the operation reached Launchpad even though we never saw it succeed (e.g. the
+    connection dropped after the POST was sent, or the daemon stopped mid-delivery), so retries never double-post.
+    """
+    params = operation.params
+    not_before = operation.created_at - CLOCK_SKEW_TOLERANCE
+    if operation.kind == "submit_and_post_inline_comment":
+        return any(
+            str(comment["line_number"]) == params["line_no"]
+            and comment["text"] == params["comment"]
+            and _timestamp(comment["date"]) >= not_before
+            for comment in get_inline_comments(params["mp_url"], params["preview_diff_id"])
+        )
+    return any(
+        comment["message"] == params["comment"] and _timestamp(comment["date_created"]) >= not_before
+        for comment in get_comments(params["mp_url"])
+    )
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, LaunchpadApiError) and error.status_code is not None:
+        return error.status_code >= 500 or error.status_code in RETRYABLE_STATUS_CODES
+    # connection errors, timeouts, ...
+    return True
+
+
+class Outbox:
+    """
+    A durable queue of outgoing Launchpad writes.
+
+    Operations are persisted to disk before `enqueue` returns and are delivered by a background worker, retrying
+    transient failures with exponential backoff. Operations that were interrupted by a restart are picked up again
+    when the worker starts.
+    """
+
+    def __init__(self, directory: str = OUTBOX_DIRECTORY):
+        self._operations = Index(directory)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _save(self, operation: OutboxOperation) -> None:
+        operation.updated_at = time.time()
+        self._operations[operation.id] = operation.model_dump()
+
+    def get(self, operation_id: str) -> Optional[OutboxOperation]:
+        operation = self._operations.get(operation_id)
+        return OutboxOperation(**operation) if operation else None
+
+    def list_operations(self, state: Optional[str] = None) -> list[OutboxOperation]:
+        operations = [OutboxOperation(**operation) for operation in self._operations.values()]
+        if state:
+            operations = [operation for operation in operations if operation.state == state]
+        return sorted(operations, key=lambda operation: operation.created_at)
+
+    def enqueue(self, kind: OperationKind, params: dict, idempotency_key: Optional[str] = None) -> OutboxOperation:
+        """
+        Persist an operation for delivery and wake up the worker.
+
+        If an operation with the same `idempotency_key` was already enqueued, that operation is returned instead and
+        nothing new is queued, so clients can safely retry their own requests.
+        """
+        with self._lock:
+            if idempotency_key:
+                for operation in self.list_operations():
+                    if operation.idempotency_key == idempotency_key:
+                        logger.info(
+                            "Operation with idempotency key %s already queued: %s", idempotency_key, operation.id
+                        )
+                        return operation
+            now = time.time()
+            operation = OutboxOperation(
+                id=str(uuid.uuid4()),
+                kind=kind,
+                params=params,
+                idempotency_key=idempotency_key,
+                created_at=now,
+                updated_at=now,
+                next_attempt_at=now,
+            )
+            self._save(operation)
+        logger.info("Queued %s operation %s", kind, operation.id)
+        self._wakeup.set()
+        return operation
+
+    def start(self) -> None:
+        """
+        Start the delivery worker, first returning operations interrupted mid-delivery to the queue.
+        """
+        for operation in self.list_operations(state="delivering"):
+            logger.info("Requeueing operation %s interrupted during delivery", operation.id)
+            operation.state = "pending"
+            self._save(operation)
+        self._thread = threading.Thread(target=self._run, name=f"{BACKGROUND_THREAD_PREFIX}outbox", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                next_wakeup = self._process_operations(time.time())
+            except Exception:
+                logger.exception("Error in outbox worker")
+                next_wakeup = time.time() + RETRY_BASE_DELAY
+            self._wakeup.wait(timeout=None if next_wakeup is None else max(next_wakeup - time.time(), 0))
+
+    def _process_operations(self, now: float) -> Optional[float]:
+        """
+        Deliver the operations that are due and forget the expired ones.
+
+        Returns:
+            Optional[float]: When the next pending operation is due, None if there is none.
+        """
+        next_wakeup = None
+        for operation in self.list_operations():
+            if operation.state in ("delivered", "failed"):
+                if now - operation.updated_at > OUTBOX_RETENTION:
+                    del self._operations[operation.id]
+                continue
+            if operation.next_attempt_at <= now:
+                self._deliver(operation)
+            # operations still pending (not due yet, or just failed) decide when the worker wakes up next
+            if operation.state == "pending":
+                next_wakeup = min(next_wakeup or operation.next_attempt_at, operation.next_attempt_at)
+        return next_wakeup
+
+    def _deliver(self, operation: OutboxOperation) -> None:
+        previously_attempted = operation.attempts > 0
+        operation.state = "delivering"
+        operation.attempts += 1
+        self._save(operation)
+        try:
+            if previously_attempted and _already_delivered(operation):
+                logger.info("Operation %s already reached Launchpad on an earlier attempt", operation.id)
+            else:
+                _DELIVERERS[operation.kind](operation.params)
+        except Exception as e:
+            operation.last_error = str(e)
+            if not _is_retryable(e) or operation.attempts >= MAX_DELIVERY_ATTEMPTS:
+                logger.error("Giving up on operation %s after %s attempt(s): %s", operation.id, operation.attempts, e)
+                operation.state = "failed"
+            else:
+                delay = min(RETRY_BASE_DELAY * 2 ** (operation.attempts - 1), RETRY_MAX_DELAY)
+                logger.warning("Delivery of operation %s failed, retrying in %ss: %s", operation.id, delay, e)
+                operation.state = "pending"
+                operation.next_attempt_at = time.time() + delay
+            self._save(operation)
+            return
+        logger.info("Delivered operation %s", operation.id)
+        operation.state = "delivered"
+        operation.last_error = None
+        self._save(operation)
@@ -0,0 +1,380 @@
+import contextvars
+import dataclasses
+import functools
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional, TypeVar
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+# Requests slower than this (wall time) are logged with a full breakdown
+SLOW_REQUEST_THRESHOLD_MS = 1000
+# Sending this header with a truthy value captures a sampling profile for that request
+PROFILE_HEADER = "X-LP-Profile"
+PROFILE_DIRECTORY = "/var/cache/lp-microservice/profiles"
+PROFILE_SAMPLE_INTERVAL = 0.005  # seconds
+MAX_SAVED_PROFILES = 50
+# Background threads owned by this service are named with this prefix so the profiler can skip them
+BACKGROUND_THREAD_PREFIX = "lp-microservice-"
+
+_PACKAGE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+T = TypeVar("T")
+
+
+##############################################################################
+# Request tracing ##############################
+##############################################################################
+
+
+@dataclasses.dataclass
+class UpstreamCall:
+    method: str
+    url: str
+    ws_op: Optional[str]
+    status: Optional[int]
+    duration_ms: float
+
+
+@dataclasses.dataclass
+class CacheOperation:
+    op: str
+    key: str
+    hit: Optional[bool]
+    duration_ms: float
+
+
+@dataclasses.dataclass
+class RequestTrace:
+    """
+    Collects where the wall time of a single request went.
+
+    The trace is stored in a context variable, so it follows the request into the threadpool thread that runs the
+    endpoint (starlette copies the context when dispatching sync endpoints).
+    """
+
+    name: str
+    started: float = dataclasses.field(default_factory=time.perf_counter)
+    upstream_calls: list[UpstreamCall] = dataclasses.field(default_factory=list)
+    cache_operations: list[CacheOperation] = dataclasses.field(default_factory=list)
+    # CPU time of the endpoint and of the jobs it fanned out to other threads, see `measure_cpu_time`
+    cpu_ms: float = 0.0
+    # when the oldest cached copy of mutable data the response is built from was fetched, see `record_data_age`
+    data_fetched_at: Optional[float] = None
+    _lock: threading.Lock = dataclasses.field(default_factory=threading.Lock, repr=False)
+
+    def add_cpu_time(self, cpu_ms: float) -> None:
+        with self._lock:
+            self.cpu_ms += cpu_ms
+
+    def add_data_fetched_at(self, fetched_at: float) -> None:
+        with self._lock:
+            if self.data_fetched_at is None or fetched_at < self.data_fetched_at:
+                self.data_fetched_at = fetched_at
+
+    @property
+    def upstream_ms(self) -> float:
+        return sum(call.duration_ms for call in self.upstream_calls)
+
+    @property
+    def cache_ms(self) -> float:
+        return sum(op.duration_ms for op in self.cache_operations)
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def summary(self) -> dict:
+        """
+        Break the wall time of the request down into upstream calls, cache operations, local CPU time and the rest.
+
+        CPU time is measured with `time.thread_time()` in the threads working on the request (JSON parsing, pydantic
+        models, rendering, ...), including the CPU used by cache operations. Other time is the wall time spent neither
+        waiting for Launchpad nor on the CPU: disk waits in the cache, waiting for locks or a free threadpool thread,
+        GIL contention and framework overhead outside the endpoint. Work done concurrently can add up to more than
+        the wall time, in which case other time is reported as 0.
+        """
+        wall_ms = self.elapsed_ms()
+        return {
+            "name": self.name,
+            "wall_ms": round(wall_ms, 2),
+            "upstream_ms": round(self.upstream_ms, 2),
+            "cache_ms": round(self.cache_ms, 2),
+            "cpu_ms": round(self.cpu_ms, 2),
+            "other_ms": round(max(wall_ms - self.upstream_ms - self.cpu_ms, 0.0), 2),
+            "upstream_calls": [dataclasses.asdict(call) for call in self.upstream_calls],
+            "cache_operations": [dataclasses.asdict(op) for op in self.cache_operations],
+        }
+
+
+_current_trace: contextvars.ContextVar[Optional[RequestTrace]] = contextvars.ContextVar(
+    "lp_microservice_trace", default=None
+)
+
+
+def get_current_trace() -> Optional[RequestTrace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def trace_request(name: str) -> Iterator[RequestTrace]:
+    """
+    Start a new trace and make it the current one for the duration of the with block.
+    """
+    trace = RequestTrace(name=name)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+def measure_cpu_time(fn: Callable[..., T]) -> Callable[..., T]:
+    """
+    Wrap a function so the CPU time of the thread running it is added to the current trace.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(*args: Any, **kwargs: Any) -> T:
+        start = time.thread_time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            trace = _current_trace.get()
+            if trace is not None:
+                trace.add_cpu_time((time.thread_time() - start) * 1000)
+
+    return wrapper
+
+
+def in_current_trace(fn: Callable[..., T]) -> Callable[..., T]:
+    """
+    Bind a function to a copy of the current context, so it can be submitted to an executor and still record its
+    upstream calls, cache operations and CPU time on the current trace. Call it once per submitted job.
+    """
+    return functools.partial(contextvars.copy_context().run, measure_cpu_time(fn))
+
+
+def _ws_op_for(url: str, params: Optional[dict]) -> Optional[str]:
+    if params and "ws.op" in params:
+        return str(params["ws.op"])
+    # some callers put the named operation directly into the url
+    ws_op = parse_qs(urlparse(url).query).get("ws.op")
+    return ws_op[0] if ws_op else None
+
+
+def record_upstream_call(
+    method: str, url: str, params: Optional[dict], status: Optional[int], duration_ms: float
+) -> None:
+    """
+    Record a Launchpad request on the current trace. Does nothing when no trace is active.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    trace.upstream_calls.append(
+        UpstreamCall(
+            method=method,
+            url=url,
+            ws_op=_ws_op_for(url, params),
+            status=status,
+            duration_ms=round(duration_ms, 2),
+        )
+    )
+
+
+def record_cache_operation(op: str, key: str, hit: Optional[bool], duration_ms: float) -> None:
+    """
+    Record a cache read or write on the current trace. Does nothing when no trace is active.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    trace.cache_operations.append(CacheOperation(op=op, key=key, hit=hit, duration_ms=round(duration_ms, 2)))
+
+
+def record_data_age(fetched_at: float) -> None:
+    """
+    Record that the current request serves data fetched from Launchpad at `fetched_at`, so the response can tell the
+    client how old it is. Does nothing when no trace is active.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    trace.add_data_fetched_at(fetched_at)
+
+
+def age_header(trace: RequestTrace) -> Optional[str]:
+    """
+    Render the age of the oldest data served as an `Age` header value (whole seconds), None if none was recorded.
+    """
+    if trace.data_fetched_at is None:
+        return None
+    return str(int(max(time.time() - trace.data_fetched_at, 0)))
+
+
+def server_timing_header(trace: RequestTrace) -> str:
+    """
+    Render the trace as a `Server-Timing` header value so the breakdown shows up in the browser devtools.
+    """
+    summary = trace.summary()
+    return (
+        f'upstream;dur={summary["upstream_ms"]};desc="{len(trace.upstream_calls)} calls", '
+        f'cache;dur={summary["cache_ms"]};desc="{len(trace.cache_operations)} ops", '
+        f"cpu;dur={summary['cpu_ms']}, "
+        f'other;dur={summary["other_ms"]};desc="waiting and overhead"'
+    )
+
+
+def log_if_slow(trace: RequestTrace) -> None:
+    summary = trace.summary()
+    if summary["wall_ms"] < SLOW_REQUEST_THRESHOLD_MS:
+        return
+    upstream_lines = [
+        f"    {call['method']} {call['url']} ws.op={call['ws_op']} ({call['status']}) {call['duration_ms']}ms"
+        for call in summary["upstream_calls"]
+    ]
+    cache_lines = [
+        f"    {op['op']} {op['key']} hit={op['hit']} {op['duration_ms']}ms" for op in summary["cache_operations"]
+    ]
+    logger.warning(
+        "[SLOW] %s took %sms (upstream %sms, cache %sms, cpu %sms, other %sms)\n  upstream calls:\n%s\n"
+        "  cache operations:\n%s",
+        summary["name"],
+        summary["wall_ms"],
+        summary["upstream_ms"],
+        summary["cache_ms"],
+        summary["cpu_ms"],
+        summary["other_ms"],
+        "\n".join(upstream_lines) or "    (none)",
+        "\n".join(cache_lines) or "    (none)",
+    )
+
+
+##############################################################################
+# Sampling profiler ############################
+##############################################################################
+
+
+def _folded_stack(frame) -> Optional[str]:
+    """
+    Turn a frame into a single line of "collapsed stack" output (root first, frames separated by `;`), the format
+    consumed by flamegraph.pl, speedscope and friends. Stacks that never enter this package are dropped.
+    """
+    frames = []
+    in_package = False
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(_PACKAGE_DIRECTORY) and filename != __file__:
+            in_package = True
+        frames.append(f"{frame.f_code.co_name} ({os.path.basename(filename)}:{frame.f_code.co_firstlineno})")
+        frame = frame.f_back
+    if not in_package:
+        return None
+    return ";".join(reversed(frames))
+
+
+class SamplingProfiler:
+    """
+    A tiny wall-clock sampling profiler.
+
+    A background thread periodically snapshots the stacks of every thread that is running code from this package and
+    counts identical stacks. The main thread (the event loop) and this service's own background threads are skipped.
+    Other requests running at the same time will show up in the profile too.
+    """
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"{BACKGROUND_THREAD_PREFIX}profiler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        skipped_thread_ids = {threading.main_thread().ident}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                if thread.name.startswith(BACKGROUND_THREAD_PREFIX):
+                    skipped_thread_ids.add(thread.ident)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in skipped_thread_ids:
+                    continue
+                stack = _folded_stack(frame)
+                if stack:
+                    self.stacks[stack] += 1
+
+    def folded(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+_armed_profiles: dict[str, int] = {}
+_armed_profiles_lock = threading.Lock()
+
+
+def arm_profiling(path_prefix: str, count: int = 1) -> None:
+    """
+    Profile the next `count` requests whose path starts with `path_prefix`, without the client sending a header.
+    """
+    with _armed_profiles_lock:
+        _armed_profiles[path_prefix] = count
+
+
+def should_profile(path: str, headers) -> bool:
+    if headers.get(PROFILE_HEADER, "").lower() in ("1", "true", "yes"):
+        return True
+    with _armed_profiles_lock:
+        for path_prefix, remaining in _armed_profiles.items():
+            if path.startswith(path_prefix):
+                if remaining <= 1:
+                    del _armed_profiles[path_prefix]
+                else:
+                    _armed_profiles[path_prefix] = remaining - 1
+                return True
+    return False
+
+
+def save_profile(profiler: SamplingProfiler, name: str) -> str:
+    """
+    Write the collected stacks to PROFILE_DIRECTORY in collapsed-stack format and return the profile id.
+    Only the newest MAX_SAVED_PROFILES profiles are kept.
+    """
+    os.makedirs(PROFILE_DIRECTORY, exist_ok=True)
+    now = time.time()
+    timestamp = f"{time.strftime('%Y%m%dT%H%M%S', time.localtime(now))}{int(now * 1000) % 1000:03d}"
+    profile_id = f"{timestamp}_{re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_')}"
+    with open(os.path.join(PROFILE_DIRECTORY, f"{profile_id}.folded"), "w", encoding="utf-8") as f:
+        f.write(profiler.folded())
+    saved_profiles = list_profiles()
+    for old_profile_id in saved_profiles[MAX_SAVED_PROFILES:]:
+        os.remove(os.path.join(PROFILE_DIRECTORY, f"{old_profile_id}.folded"))
+    logger.info("Saved profile %s (%s samples)", profile_id, sum(profiler.stacks.values()))
+    return profile_id
+
+
+def list_profiles() -> list[str]:
+    """
+    List saved profile ids, newest first.
+    """
+    if not os.path.isdir(PROFILE_DIRECTORY):
+        return []
+    profile_ids = [name.removesuffix(".folded") for name in os.listdir(PROFILE_DIRECTORY) if name.endswith(".folded")]
+    return sorted(profile_ids, reverse=True)
+
+
+def read_profile(profile_id: str) -> Optional[str]:
+    if profile_id not in list_profiles():
+        return None
+    with open(os.path.join(PROFILE_DIRECTORY, f"{profile_id}.folded"), "r", encoding="utf-8") as f:
+        return f.read()
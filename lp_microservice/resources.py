@@ -0,0 +1,381 @@
+import concurrent.futures
+import datetime
+import functools
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from typing import Callable, Optional, TypeVar, Union
+
+from lp_microservice.cache import CACHE, cache_key
+from lp_microservice.compression import EncodedPayload, encode_payload, json_bytes
+from lp_microservice.diff_render import RENDER_FORMAT_VERSION, render_diff
+from lp_microservice.lp_service import (
+    MergeProposalApiObject,
+    get_comments,
+    get_inline_comments,
+    get_merge_proposal,
+    get_person,
+    get_preview_diff_text,
+    get_review_votes,
+)
+from lp_microservice.profiling import BACKGROUND_THREAD_PREFIX, in_current_trace, record_data_age
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# How long cached copies of mutable resources are served before they are refreshed in the background
+COMMENTS_FRESH_FOR = 30  # seconds
+MERGE_PROPOSAL_FRESH_FOR = 60  # seconds
+# People rarely change their name or mugshot
+PERSON_FRESH_FOR = 24 * 60 * 60  # seconds
+# Cached copies older than this are never served, the caller waits for Launchpad instead. Comments and MPs change
+# while they are reviewed, so their copies are only served for a few minutes.
+COMMENTS_MAX_STALE = 5 * 60  # seconds
+MERGE_PROPOSAL_MAX_STALE = 5 * 60  # seconds
+PERSON_MAX_STALE = 7 * 24 * 60 * 60  # seconds
+# Maximum number of people fetched at the same time when resolving the authors of a listing
+PEOPLE_MAX_WORKERS = 8
+
+_refresh_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix=f"{BACKGROUND_THREAD_PREFIX}refresh"
+)
+_refreshing: set[str] = set()
+_refreshing_lock = threading.Lock()
+
+
+##############################################################################
+# Immutable resources ##########################
+##############################################################################
+
+
+def _get_encoded_cached(key: str, serialize: Callable[[], bytes]) -> EncodedPayload:
+    cached_result: Optional[EncodedPayload] = CACHE.get(key)
+    if cached_result:
+        return cached_result
+    logger.debug("No cached result found with key: %s", key)
+    result = encode_payload(serialize(), precompress=True)
+    # No expiration since preview diffs are immutable
+    CACHE.set(key=key, value=result, expire=None)
+    return result
+
+
+def get_preview_diff_text_encoded(mp_url: str, preview_diff_id: Union[str, int]) -> EncodedPayload:
+    """
+    Get the preview diff text ready to be served: serialized, hashed for its ETag and gzipped once, then cached.
+    This is the only cached copy of the text, `get_preview_diff_text_cached` decodes it.
+    """
+    return _get_encoded_cached(
+        cache_key("diff_text_encoded", mp_url, preview_diff_id),
+        lambda: get_preview_diff_text(mp_url, str(preview_diff_id)).encode("utf-8"),
+    )
+
+
+def get_rendered_diff_encoded(mp_url: str, preview_diff_id: Union[str, int]) -> EncodedPayload:
+    """
+    Get the rendered preview diff ready to be served, see `get_preview_diff_text_encoded`.
+    """
+    return _get_encoded_cached(
+        cache_key("rendered_diff_encoded", mp_url, preview_diff_id, f"v{RENDER_FORMAT_VERSION}"),
+        lambda: json_bytes(render_diff(get_preview_diff_text_cached(mp_url, preview_diff_id))),
+    )
+
+
+def get_preview_diff_text_cached(mp_url: str, preview_diff_id: Union[str, int]) -> str:
+    return get_preview_diff_text_encoded(mp_url, preview_diff_id).body.decode("utf-8")
+
+
+def get_rendered_diff_cached(mp_url: str, preview_diff_id: Union[str, int]) -> dict:
+    rendered_diff: dict = json.loads(get_rendered_diff_encoded(mp_url, preview_diff_id).body)
+    return rendered_diff
+
+
+##############################################################################
+# Mutable resources ############################
+##############################################################################
+
+
+def _fetch_and_store(key: str, fetch: Callable[[], T], max_stale: float) -> T:
+    value = fetch()
+    CACHE.set(key=key, value={"fetched_at": time.time(), "value": value}, expire=max_stale)
+    return value
+
+
+def refresh_in_background(key: str, refresh: Callable[[], object]) -> None:
+    """
+    Run `refresh` on a background thread, unless a refresh of the same key is already queued or running. Failures
+    are logged.
+    """
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def run():
+        try:
+            refresh()
+        except Exception:
+            logger.exception("Background refresh of %s failed", key)
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    _refresh_executor.submit(run)
+
+
+def _servable_entry(key: str, fetch: Callable[[], T], fresh_for: float, max_stale: float) -> Optional[dict]:
+    """
+    The cached entry (`fetched_at` and `value`) for `key`, None when there is none or it is older than `max_stale`.
+    An entry older than `fresh_for` is refreshed in the background.
+    """
+    entry: Optional[dict] = CACHE.get(key)
+    if entry is None or time.time() - entry["fetched_at"] > max_stale:
+        return None
+    if time.time() - entry["fetched_at"] > fresh_for:
+        refresh_in_background(key, lambda: _fetch_and_store(key, fetch, max_stale))
+    return entry
+
+
+def _get_stale_while_revalidate(
+    key: str,
+    fetch: Callable[[], T],
+    fresh_for: float,
+    max_stale: float,
+    refresh: bool,
+    report_age: bool = True,
+) -> T:
+    """
+    Serve a cached copy of a mutable resource, refreshing it in the background once it is older than `fresh_for`.
+    A cache miss, a copy older than `max_stale` or `refresh=True` makes the caller wait for Launchpad.
+
+    `fetch` must raise when Launchpad fails, so a failed fetch reaches the caller (or the log, in the background)
+    and the previous copy stays cached.
+
+    With `report_age`, the age of the copy is recorded on the request trace and sent to the client as the `Age`
+    header of the response.
+    """
+    entry = None if refresh else _servable_entry(key, fetch, fresh_for, max_stale)
+    if entry is None:
+        fetched_at = time.time()
+        value = _fetch_and_store(key, fetch, max_stale)
+    else:
+        value = entry["value"]
+        fetched_at = entry["fetched_at"]
+    if report_age:
+        record_data_age(fetched_at)
+    return value
+
+
+def get_comments_cached(mp_url: str, refresh: bool = False) -> list[dict]:
+    return _get_stale_while_revalidate(
+        cache_key("comments", mp_url), lambda: get_comments(mp_url), COMMENTS_FRESH_FOR, COMMENTS_MAX_STALE, refresh
+    )
+
+
+def get_inline_comments_cached(mp_url: str, preview_diff_id: Union[str, int], refresh: bool = False) -> list[dict]:
+    return _get_stale_while_revalidate(
+        cache_key("inline_comments", mp_url, preview_diff_id),
+        lambda: get_inline_comments(mp_url, str(preview_diff_id)),
+        COMMENTS_FRESH_FOR,
+        COMMENTS_MAX_STALE,
+        refresh,
+    )
+
+
+class InvalidSince(ValueError):
+    """
+    Raised when the `since` of an incremental query is neither a comment id nor a timestamp.
+    """
+
+
+def _parse_since_timestamp(since: str) -> datetime.datetime:
+    try:
+        return _parse_timestamp(since)
+    except ValueError as e:
+        raise InvalidSince(since) from e
+
+
+def _parse_timestamp(timestamp: str) -> datetime.datetime:
+    # Launchpad timestamps are ISO 8601 with an offset, clients may send a Z suffix or no offset at all (UTC)
+    parsed = datetime.datetime.fromisoformat(timestamp.strip().replace("Z", "+00:00"))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=datetime.timezone.utc)
+
+
+def _changed_since(timestamps: list[Optional[str]], since: datetime.datetime) -> bool:
+    return any(timestamp and _parse_timestamp(timestamp) > since for timestamp in timestamps)
+
+
+def get_comments_since(mp_url: str, since: str, refresh: bool = False) -> list[dict]:
+    """
+    Get only the comments of an MP that a client which has already seen them up to `since` is missing, filtered from
+    the cached copy.
+
+    Args:
+        mp_url (str): The MP URL.
+        since (str): Either the id of the newest comment the client has, to get the comments posted after it, or an
+            ISO 8601 timestamp, to get the comments posted or edited after it.
+        refresh (bool): Fetch the comments from Launchpad instead of filtering the cached copy.
+
+    Returns:
+        list[dict]: The new (and edited) comments, oldest first.
+
+    Raises:
+        InvalidSince: If `since` is neither a comment id nor a timestamp.
+    """
+    if since.strip().isdigit():
+        return [comment for comment in get_comments_cached(mp_url, refresh) if comment["id"] > int(since)]
+    since_time = _parse_since_timestamp(since)
+    return [
+        comment
+        for comment in get_comments_cached(mp_url, refresh)
+        if _changed_since([comment["date_created"], comment["date_last_edited"]], since_time)
+    ]
+
+
+def get_inline_comments_since(
+    mp_url: str, preview_diff_id: Union[str, int], since: str, refresh: bool = False
+) -> list[dict]:
+    """
+    Get only the inline comments of a preview diff made after the ISO 8601 timestamp `since`, filtered from the cached
+    copy. Inline comments have no ids, so unlike `get_comments_since` only timestamps are accepted.
+
+    Raises:
+        InvalidSince: If `since` is not a timestamp.
+    """
+    since_time = _parse_since_timestamp(since)
+    return [
+        comment
+        for comment in get_inline_comments_cached(mp_url, preview_diff_id, refresh)
+        if _changed_since([comment["date"]], since_time)
+    ]
+
+
+def get_review_votes_cached(mp_url: str, refresh: bool = False) -> list[dict]:
+    return _get_stale_while_revalidate(
+        cache_key("votes", mp_url), lambda: get_review_votes(mp_url), COMMENTS_FRESH_FOR, COMMENTS_MAX_STALE, refresh
+    )
+
+
+def get_vote_summary(mp_url: str) -> dict:
+    """
+    Summarize who reviewed an MP and how: every requested or given review with its state, and a tally of the states.
+    A review's state is its vote (taken from the review comment) or "Pending" while the review is still requested.
+    """
+    votes = get_review_votes_cached(mp_url)
+    comment_votes = {}
+    if any(not vote["is_pending"] for vote in votes):
+        comment_votes = {comment["self_link"]: comment["vote"] for comment in get_comments_cached(mp_url)}
+    reviewers = []
+    for vote in votes:
+        state = "Pending" if vote["is_pending"] else comment_votes.get(vote["comment_link"]) or "Unknown"
+        reviewers.append({**vote, "state": state})
+    return {
+        "mp_url": mp_url,
+        "tally": dict(Counter(reviewer["state"] for reviewer in reviewers)),
+        "reviewers": reviewers,
+    }
+
+
+def get_merge_proposal_cached(mp_url: str, refresh: bool = False) -> Optional[dict]:
+    """
+    Get an MP, None if Launchpad has no MP at `mp_url`.
+
+    Raises:
+        LaunchpadApiError: If Launchpad fails to answer. Nothing is cached then.
+    """
+
+    def fetch() -> Optional[dict]:
+        mp = get_merge_proposal(mp_url)
+        return mp.model_dump() if mp else None
+
+    return _get_stale_while_revalidate(
+        cache_key("merge_proposal", mp_url), fetch, MERGE_PROPOSAL_FRESH_FOR, MERGE_PROPOSAL_MAX_STALE, refresh
+    )
+
+
+def get_person_cached(person_link: str, refresh: bool = False) -> Optional[dict]:
+    """
+    Get a person, None if Launchpad has no such person.
+
+    Raises:
+        LaunchpadApiError: If Launchpad fails to answer. Nothing is cached then, so the next lookup tries again.
+    """
+
+    # an author's name is not what makes a listing stale, so people don't count towards the age of the response
+    return _get_stale_while_revalidate(
+        cache_key("person", person_link),
+        lambda: _fetch_person(person_link),
+        PERSON_FRESH_FOR,
+        PERSON_MAX_STALE,
+        refresh,
+        report_age=False,
+    )
+
+
+def _fetch_person(person_link: str) -> Optional[dict]:
+    person = get_person(person_link)
+    return person.model_dump() if person else None
+
+
+def get_people_cached(person_links: list[str]) -> dict[str, Optional[dict]]:
+    """
+    Resolve many people at once. Each distinct person is looked up once, cached people on the calling thread, and
+    the missing ones are fetched concurrently.
+
+    Returns:
+        dict[str, Optional[dict]]: The person (see `lp_service.Person`) by link. None for people that could not be
+            fetched.
+    """
+
+    def resolve(person_link: str) -> Optional[dict]:
+        try:
+            return get_person_cached(person_link)
+        except Exception:
+            logger.exception("Fetching person %s failed", person_link)
+            return None
+
+    people: dict[str, Optional[dict]] = {}
+    missing = []
+    for person_link in dict.fromkeys(person_links):
+        entry = _servable_entry(
+            cache_key("person", person_link),
+            functools.partial(_fetch_person, person_link),
+            PERSON_FRESH_FOR,
+            PERSON_MAX_STALE,
+        )
+        if entry is None:
+            missing.append(person_link)
+        else:
+            people[person_link] = entry["value"]
+    if len(missing) <= 1:
+        people.update((person_link, resolve(person_link)) for person_link in missing)
+        return people
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(missing), PEOPLE_MAX_WORKERS)) as executor:
+        futures = [executor.submit(in_current_trace(resolve), person_link) for person_link in missing]
+        people.update((person_link, future.result()) for person_link, future in zip(missing, futures))
+    return people
+
+
+def with_authors(comments: list[dict]) -> list[dict]:
+    """
+    Add the full `author` (see `lp_service.Person`) to comments that only carry an `author_link`.
+    """
+    people = get_people_cached([comment["author_link"] for comment in comments])
+    return [{**comment, "author": people[comment["author_link"]]} for comment in comments]
+
+
+def invalidate_comments(mp_url: str, preview_diff_id: Optional[Union[str, int]] = None) -> None:
+    """
+    Drop the cached comments of an MP (and the inline comments of one of its preview diffs) after posting to it, so
+    the poster sees their own comment on the next load.
+    """
+    CACHE.delete(cache_key("comments", mp_url))
+    if preview_diff_id is not None:
+        CACHE.delete(cache_key("inline_comments", mp_url, preview_diff_id))
+
+
+def preview_diff_id_of(mp: MergeProposalApiObject) -> str:
+    # preview_diff_link looks like https://api.launchpad.net/devel/~owner/project/+git/repo/+merge/123/+preview-diff/456
+    return mp.preview_diff_link.rstrip("/").split("/")[-1]
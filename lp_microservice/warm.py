@@ -0,0 +1,120 @@
+import argparse
+import concurrent.futures
+import logging
+import sys
+import time
+
+from lp_microservice.log_pipeline import configure_logging
+from lp_microservice.lp_service import (
+    MergeProposalApiObject,
+    get_basic_mps_info_for_project,
+    wait_for_credentials,
+)
+from lp_microservice.mp_index import ACTIVE_STATUSES
+from lp_microservice.profiling import in_current_trace, trace_request
+from lp_microservice.resources import get_rendered_diff_encoded, preview_diff_id_of
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_MAX_UPSTREAM_CALLS = 1000
+
+
+def warm_merge_proposal(mp: MergeProposalApiObject) -> None:
+    """
+    Fill the cache with the rendered latest preview diff of an MP (and its text), the slowest part of opening it.
+
+    Comments and MP metadata are not warmed: cached copies of them are only served for a few minutes (see
+    `resources.COMMENTS_MAX_STALE`), so they would be fetched again by the time the MP is opened.
+    """
+    get_rendered_diff_encoded(mp.web_link, preview_diff_id_of(mp))
+
+
+def _parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="lp_microservice_warm",
+        description="Pre-fill the lp-microservice cache with the open merge proposals of projects and teams.",
+    )
+    parser.add_argument(
+        "--project", action="append", default=[], help="Project to warm the MPs of. Can be given multiple times."
+    )
+    parser.add_argument(
+        "--team", action="append", default=[], help="Team (or person) to warm the MPs of. Can be given multiple times."
+    )
+    parser.add_argument(
+        "--status",
+        action="append",
+        help=f"Only warm MPs with this status. Can be given multiple times (default: {', '.join(ACTIVE_STATUSES)}).",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="Number of MPs warmed at the same time (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--max-upstream-calls",
+        type=int,
+        default=DEFAULT_MAX_UPSTREAM_CALLS,
+        help="Stop starting new MPs once this many requests were sent to Launchpad (default: %(default)s).",
+    )
+    args = parser.parse_args(argv)
+    if not args.project and not args.team:
+        parser.error("at least one --project or --team is required")
+    if not args.status:
+        args.status = list(ACTIVE_STATUSES)
+    return args
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    configure_logging(default_format="text")
+    if not wait_for_credentials(timeout=0):
+        print("Not authenticated with Launchpad. Run the initialize command first.")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    with trace_request("warm") as trace:
+        mps: dict[str, MergeProposalApiObject] = {}
+        # teams are people too, and people have merge proposals just like projects do
+        for target in args.project + [f"~{team}" for team in args.team]:
+            target_mps = [
+                mp for status in args.status for mp in get_basic_mps_info_for_project(target, status=status)
+            ]
+            print(f"Found {len(target_mps)} MPs for {target}")
+            # the same MP can show up for both its project and a team
+            mps.update((mp.self_link, mp) for mp in target_mps)
+
+        def warm(mp: MergeProposalApiObject) -> bool:
+            if len(trace.upstream_calls) >= args.max_upstream_calls:
+                return False
+            warm_merge_proposal(mp)
+            return True
+
+        warmed = skipped = failed = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            # every worker runs in a copy of this context so its Launchpad requests count towards the budget
+            futures = {executor.submit(in_current_trace(warm), mp): mp for mp in mps.values()}
+            for done, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+                mp = futures[future]
+                try:
+                    was_warmed = future.result()
+                except Exception as e:
+                    failed += 1
+                    outcome = f"failed: {e}"
+                    logger.debug("Warming %s failed", mp.web_link, exc_info=True)
+                else:
+                    if was_warmed:
+                        warmed += 1
+                        outcome = "warmed"
+                    else:
+                        skipped += 1
+                        outcome = "skipped (upstream budget exhausted)"
+                print(f"[{done}/{len(mps)}] {mp.web_link} {outcome} ({len(trace.upstream_calls)} upstream calls)")
+
+    print(
+        f"Warmed {warmed} MPs ({skipped} skipped, {failed} failed) with {len(trace.upstream_calls)} upstream calls "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+    if failed:
+        sys.exit(1)